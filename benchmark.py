@@ -0,0 +1,583 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+"""
+Exporter benchmarks on synthetic scenes. Run in background Blender:
+
+    blender --background --factory-startup --python benchmark.py -- geom --triangles 200000
+    blender --background --factory-startup --python benchmark.py -- tangents --uv-layers 4
+    blender --background --factory-startup --python benchmark.py -- armature --bones 1500
+    blender --background --factory-startup --python benchmark.py -- triangles --faces 500000
+    blender --background --factory-startup --python benchmark.py -- suite --save baseline.json
+    blender --background --factory-startup --python benchmark.py -- suite --compare baseline.json
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import bmesh
+import bpy
+import mathutils
+import numpy as np
+
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_addon():
+    sys.path.insert(0, os.path.dirname(ADDON_DIR))
+    return importlib.import_module(os.path.basename(ADDON_DIR))
+
+
+class Args(object):
+    inputs = []
+    output = None
+    export = 'scene'
+    render = 'default'
+    exec = None
+    action = None
+    speed = None
+    scale = None
+    merge = None
+    keep = None
+    no_extra_uv = None
+    no_materials = None
+    no_textures = None
+    empty_textures = None
+    set_origin = None
+    normalize_weights = None
+
+    def __init__(self, output, **kw):
+        self.output = output
+        for k, v in kw.items():
+            setattr(self, k, v)
+
+
+def clear_scene():
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+
+
+def make_grid(name, triangles, uv_layers=1):
+    """
+    Make a smooth shaded grid mesh object with about given triangles count.
+    """
+    side = max(1, int((triangles / 2) ** 0.5))
+    xs, ys = np.meshgrid(
+        np.linspace(-1, 1, side + 1, dtype=np.float32),
+        np.linspace(-1, 1, side + 1, dtype=np.float32))
+    co = np.column_stack((xs.ravel(), ys.ravel(), np.zeros(xs.size, np.float32)))
+    co[:, 2] = np.sin(co[:, 0] * 7) * np.cos(co[:, 1] * 5) * 0.1
+
+    rows, cols = np.meshgrid(np.arange(side), np.arange(side), indexing='ij')
+    first = (rows * (side + 1) + cols).ravel()
+    quads = np.column_stack((first, first + 1, first + side + 2, first + side + 1))
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(co))
+    mesh.vertices.foreach_set('co', co.ravel())
+    mesh.loops.add(quads.size)
+    mesh.loops.foreach_set('vertex_index', quads.ravel().astype(np.int32))
+    mesh.polygons.add(len(quads))
+    mesh.polygons.foreach_set('loop_start', np.arange(0, quads.size, 4, dtype=np.int32))
+    mesh.polygons.foreach_set('loop_total', np.full(len(quads), 4, dtype=np.int32))
+    mesh.polygons.foreach_set('use_smooth', np.ones(len(quads), dtype=bool))
+    mesh.update(calc_edges=True)
+
+    loop_co = co[quads.ravel()]
+    for i in range(uv_layers):
+        layer = mesh.uv_layers.new(name='UVMap' if i == 0 else 'UVMap.{:03d}'.format(i))
+        uvs = (loop_co[:, :2] + 1) / 2 * (i + 1)
+        layer.data.foreach_set('uv', uvs.astype(np.float32).ravel())
+
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+    return obj
+
+
+def compare_buffers(buffer1, buffer2):
+    """
+    Returns max difference between two exported buffers, None if layout differs.
+    """
+    if len(buffer1._metadata) != len(buffer2._metadata):
+        return None
+
+    diff = 0
+    for i, (m1, m2) in enumerate(zip(buffer1._metadata, buffer2._metadata)):
+        if (m1['type'], m1['componentType'], m1['count']) != (m2['type'], m2['componentType'], m2['count']):
+            return None
+        a1 = buffer1.read_array(i).astype(np.float64)
+        a2 = buffer2.read_array(i).astype(np.float64)
+        if a1.size:
+            diff = max(diff, float(np.abs(a1 - a2).max()))
+    return diff
+
+
+def export_geom(addon, output, engine):
+    exporter = addon.gltfmodel.GLTFExporter(Args(output, geom_engine=engine))
+    start = time.perf_counter()
+    root, buffer_ = exporter.convert()
+    return time.perf_counter() - start, root, buffer_
+
+
+def bench_geom(addon, options):
+    clear_scene()
+    make_grid('Grid', options.triangles)
+    output = os.path.join(tempfile.gettempdir(), 'benchmark.gltf')
+
+    results = {}
+    for engine in ('python', 'numpy'):
+        results[engine] = export_geom(addon, output, engine)
+        print('{:>8}: {:.3f}s'.format(engine, results[engine][0]))
+
+    diff = compare_buffers(results['python'][2], results['numpy'][2])
+    print('speedup: {:.1f}x'.format(results['python'][0] / results['numpy'][0]))
+    print('max difference: {}'.format('LAYOUT MISMATCH' if diff is None else diff))
+
+
+def legacy_tangent_bitangent(mesh):
+    """
+    Tangents of all UV layers as lists of Vectors, as the exporter used to do.
+    """
+    results = {}
+    for uv_name, uv_layer in mesh.uv_layers.items():
+        mesh.calc_tangents(uvmap=uv_name)
+        results[uv_name] = []
+        for i, loop in mesh.loops.items():
+            results[uv_name].append((
+                mathutils.Vector(loop.tangent),
+                mathutils.Vector(loop.bitangent),
+                loop.bitangent_sign,
+            ))
+        mesh.free_tangents()
+    return results
+
+
+def measure(func, *args):
+    """
+    Returns (seconds, peak python memory in bytes, result) of the call.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak, result
+
+
+def measure_rss(addon, func, *args):
+    """
+    Returns (seconds, peak process memory growth in bytes, result) of the call,
+    the growth is None when the platform can't tell.
+    Blender allocates mesh data outside of python, so tracemalloc doesn't
+    see it. The peak only grows, measure the smaller one first.
+    """
+    memory = importlib.import_module(addon.__name__ + '.mixin.dasar.memory')
+    before = memory.get_peak_rss()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    after = memory.get_peak_rss()
+    if before is None or after is None:
+        return seconds, None, result
+    return seconds, after - before, result
+
+
+def legacy_triangles(obj):
+    """
+    Triangles by a bmesh triangulation of a mesh copy, as the exporter used to do.
+    """
+    mesh = obj.to_mesh()
+    b_mesh = bmesh.new()
+    b_mesh.from_mesh(mesh)
+    bmesh.ops.triangulate(b_mesh, faces=b_mesh.faces)
+    b_mesh.to_mesh(mesh)
+    b_mesh.free()
+    loops = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get('vertex_index', loops)
+    obj.to_mesh_clear()
+    return loops.reshape(-1, 3)
+
+
+def loop_triangles(obj):
+    mesh = obj.data
+    mesh.calc_loop_triangles()
+    vertices = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('vertices', vertices)
+    return vertices.reshape(-1, 3)
+
+
+def bench_triangles(addon, options):
+    clear_scene()
+    obj = make_grid('Grid', options.faces * 2)  # quads
+
+    memory = importlib.import_module(addon.__name__ + '.mixin.dasar.memory')
+    bulk = measure_rss(addon, loop_triangles, obj)
+    legacy = measure_rss(addon, legacy_triangles, obj)
+    for name, (seconds, peak, _) in (('legacy', legacy), ('loop_tri', bulk)):
+        print('{:>8}: {:.3f}s, peak +{}'.format(name, seconds, memory.format_size(peak)))
+    print('triangles: {} / {}'.format(len(legacy[2]), len(bulk[2])))
+
+
+def bench_tangents(addon, options):
+    clear_scene()
+    mesh = make_grid('Grid', options.triangles, uv_layers=options.uv_layers).data
+    exporter = addon.gltfmodel.GLTFExporter(
+        Args(os.path.join(tempfile.gettempdir(), 'benchmark_tangents.glb')))
+
+    legacy = measure(legacy_tangent_bitangent, mesh)
+    bulk = measure(exporter.get_tangent_bitangent, mesh, [mesh.uv_layers.active.name])
+    for name, (seconds, peak, _) in (('legacy', legacy), ('bulk', bulk)):
+        print('{:>8}: {:.3f}s, peak {:.1f} MB'.format(name, seconds, peak / 1024 ** 2))
+
+    uv_name = mesh.uv_layers.active.name
+    tangents = np.array([t for t, b, s in legacy[2][uv_name]], dtype=np.float32)
+    print('max difference: {}'.format(float(np.abs(tangents - bulk[2][uv_name][0]).max())))
+
+
+def add_hair_bones(armature, parent, bones, chain_length=10, top=0.2):
+    """
+    Add hair strands, chains of bones under the parent edit bone.
+    Call in edit mode, returns names of the new bones.
+    """
+    names = []
+    for i in range(bones):
+        strand, link = divmod(i, chain_length)
+        bone = armature.edit_bones.new('Hair_{:03d}_{:02d}'.format(strand, link))
+        angle = strand * 0.618 * 2 * np.pi
+        x, y = np.cos(angle) * 0.1, np.sin(angle) * 0.1
+        bone.head = (x, y, top - link * 0.03)
+        bone.tail = (x, y, top - (link + 1) * 0.03)
+        bone.parent = parent if link == 0 else armature.edit_bones[
+            'Hair_{:03d}_{:02d}'.format(strand, link - 1)]
+        names.append(bone.name)
+    return names
+
+
+def make_hair_rig(name, bones, chain_length=10):
+    """
+    Make an armature of hair strands, chains of bones under one head bone.
+    """
+    armature = bpy.data.armatures.new(name)
+    obj = bpy.data.objects.new(name, armature)
+    bpy.context.scene.collection.objects.link(obj)
+    bpy.context.view_layer.objects.active = obj
+
+    bpy.ops.object.mode_set(mode='EDIT')
+    head = armature.edit_bones.new('Head')
+    head.tail = (0, 0, 0.2)
+    add_hair_bones(armature, head, bones - 1, chain_length)
+    bpy.ops.object.mode_set(mode='OBJECT')
+    return obj
+
+
+def bench_armature(addon, options):
+    clear_scene()
+    make_hair_rig('Rig', options.bones)
+    output = os.path.join(tempfile.gettempdir(), 'benchmark.gltf')
+    exporter = addon.gltfmodel.GLTFExporter(Args(output, export='scene'))
+
+    seconds, peak, (root, buffer_) = measure(exporter.convert)
+    print('  export: {:.3f}s, {} nodes'.format(seconds, len(root['nodes'])))
+
+    # name lookups as the exporter does them, for every bone
+    names = [bone.name for bone in bpy.data.objects['Rig'].data.bones]
+    start = time.perf_counter()
+    linear = [
+        next(i for i, node in enumerate(root['nodes']) if node['name'] == name)
+        for name in names]
+    linear_time = time.perf_counter() - start
+    start = time.perf_counter()
+    indexed = [root.find('nodes', name) for name in names]
+    indexed_time = time.perf_counter() - start
+    print('  linear: {:.3f}s'.format(linear_time))
+    print(' indexed: {:.3f}s'.format(indexed_time))
+    print('same results: {}'.format(linear == indexed))
+
+
+# avatar scenarios of the suite, the smallest first because peak RSS only grows
+SCENARIOS = {
+    'small': {
+        'triangles': 20000, 'shape_keys': 18, 'uv_layers': 1,
+        'spring_bones': 20, 'actions': 1,
+    },
+    'medium': {
+        'triangles': 100000, 'shape_keys': 52, 'uv_layers': 2,
+        'spring_bones': 100, 'actions': 3,
+    },
+    'large': {
+        'triangles': 400000, 'shape_keys': 120, 'uv_layers': 4,
+        'spring_bones': 400, 'actions': 8,
+    },
+}
+
+# metrics compared with the baseline, higher is worse
+SUITE_METRICS = ('time', 'peak', 'size')
+
+
+def foreach_co(mesh):
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', co)
+    return co.reshape(-1, 3)
+
+
+def weight_to_bones(obj, rig, bone_names):
+    """
+    Weight every vertex to the two nearest bone heads.
+    """
+    co = foreach_co(obj.data)
+    heads = np.array([
+        rig.data.bones[name].head_local for name in bone_names], dtype=np.float32)
+    distances = np.linalg.norm(co[:, None, :] - heads[None, :, :], axis=2)
+    nearest = np.argsort(distances, axis=1)[:, :2]
+
+    for bone_id, name in enumerate(bone_names):
+        group = obj.vertex_groups.new(name=name)
+        for layer, weight in ((0, 0.7), (1, 0.3)):
+            vertices = np.flatnonzero(nearest[:, layer] == bone_id)
+            if len(vertices):
+                group.add(vertices.tolist(), weight, 'REPLACE')
+
+
+def add_shape_keys(obj, count):
+    """
+    Add the VRM shape keys by generate_bsk, trimmed or extended to count.
+    Every key moves its own band of vertices.
+    """
+    if not count:
+        return
+
+    bpy.ops.obj.generate_bsk()
+    key_blocks = obj.data.shape_keys.key_blocks
+    while len(key_blocks) - 1 > count:
+        obj.shape_key_remove(key_blocks[-1])
+    while len(key_blocks) - 1 < count:
+        obj.shape_key_add(name='Extra_{:03d}'.format(len(key_blocks) - 1))
+
+    basis = foreach_co(obj.data)
+    band = max(1, len(basis) // 20)
+    for i, key_block in enumerate(key_blocks[1:]):
+        co = basis.copy()
+        start = i * len(basis) // count
+        co[start:start + band, 1] += 0.01
+        key_block.data.foreach_set('co', co.ravel())
+
+
+def add_actions(rig, count, bone_names, frames=60):
+    """
+    Add actions with a rotation key every 10 frames on the given bones.
+    """
+    rig.animation_data_create()
+    for i in range(count):
+        rig.animation_data.action = bpy.data.actions.new('Action_{:02d}'.format(i))
+        for frame in range(1, frames + 2, 10):
+            for j, name in enumerate(bone_names):
+                pose_bone = rig.pose.bones[name]
+                angle = np.sin(frame * 0.1 + i + j) * 0.3
+                pose_bone.rotation_quaternion = mathutils.Quaternion((1, 0, 0), angle)
+                pose_bone.keyframe_insert('rotation_quaternion', frame=frame)
+    rig.animation_data.action = None
+
+
+def make_avatar(addon, triangles, shape_keys, uv_layers, spring_bones, actions):
+    """
+    Make a VRM avatar scene: the template rig of generate_rig with hair
+    spring bones and a skinned body grid with generate_bsk shape keys.
+    """
+    clear_scene()
+    if not hasattr(bpy.types.Scene, 'vrm_meta'):
+        addon.register()
+    meta = bpy.context.scene.vrm_meta
+
+    bpy.ops.obj.generate_rig(nama='Armature', terap=True)
+    rig = meta.rig
+    body_bones = [bone.name for bone in rig.data.bones]
+
+    bpy.ops.object.mode_set(mode='EDIT')
+    hair = add_hair_bones(rig.data, rig.data.edit_bones['head'], spring_bones, top=1.95)
+    bpy.ops.object.mode_set(mode='OBJECT')
+    for name in hair:
+        rig.pose.bones[name].vrmprop_aktif = 'Spring'
+
+    body = make_grid('Body', triangles, uv_layers)
+    # stand the grid up, from the feet to the head
+    body.data.transform(mathutils.Matrix((
+        (0.4, 0, 0, 0),
+        (0, 0, 1, 0),
+        (0, 1, 0, 1),
+        (0, 0, 0, 1))))
+    body.parent = rig
+    body.modifiers.new('Armature', 'ARMATURE').object = rig
+    weight_to_bones(body, rig, body_bones)
+    meta.model = body
+
+    add_shape_keys(body, shape_keys)
+    add_actions(rig, actions, [
+        name for name in ('spine', 'chest', 'neck', 'head') if name in body_bones])
+
+
+def export_avatar(addon, output, engine):
+    exporter = addon.operatorvrm.VRMExporter(Args(output, geom_engine=engine))
+    root, buffer_ = exporter.convert()
+    exporter.write(root, output, is_binary=True)
+
+
+def run_scenario(addon, name, params, options):
+    """
+    Returns metrics of the scenario: best time of the repeats, traced
+    memory peak and stages of a profiled run, peak RSS and output size.
+    """
+    g2_debug = importlib.import_module(addon.__name__ + '.impread.write.dasar.g2_debug')
+    memory = importlib.import_module(addon.__name__ + '.mixin.dasar.memory')
+    output = os.path.join(tempfile.gettempdir(), 'benchmark_{}.vrm'.format(name))
+
+    times = []
+    for _ in range(options.repeat):
+        make_avatar(addon, **params)
+        start = time.perf_counter()
+        export_avatar(addon, output, options.geom_engine)
+        times.append(time.perf_counter() - start)
+
+    # memory tracing slows the export down, it gets a run of its own
+    make_avatar(addon, **params)
+    profiler = g2_debug.Profiler()
+    g2_debug.set_profiler(profiler)
+    profiler.start()
+    try:
+        export_avatar(addon, output, options.geom_engine)
+    finally:
+        profiler.stop()
+        g2_debug.set_profiler(None)
+
+    return {
+        'params': params,
+        'time': min(times),
+        'peak': profiler.peak,
+        'peak_rss': memory.get_peak_rss(),
+        'size': os.path.getsize(output),
+        'stages': profiler.stages,
+    }
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Print changes of the metrics from the baseline,
+    returns count of metrics which are worse than the tolerance.
+    """
+    regressions = 0
+    for name, result in results.items():
+        base = baseline['scenarios'].get(name)
+        if base is None or base['params'] != result['params']:
+            print('{:>8}: not in the baseline'.format(name))
+            continue
+
+        for metric in SUITE_METRICS:
+            ratio = result[metric] / base[metric] if base[metric] else 1
+            flag = ''
+            if ratio > 1 + tolerance:
+                flag = '  REGRESSION'
+                regressions += 1
+            print('{:>8}: {:>5} {:+.1%}{}'.format(name, metric, ratio - 1, flag))
+    return regressions
+
+
+def bench_suite(addon, options):
+    scenarios = {name: SCENARIOS[name] for name in options.scenarios}
+    custom = {
+        'triangles': options.triangles, 'shape_keys': options.shape_keys,
+        'uv_layers': options.uv_layers, 'spring_bones': options.spring_bones,
+        'actions': options.actions,
+    }
+    if any(value is not None for value in custom.values()):
+        base = SCENARIOS['small']
+        scenarios = {'custom': {
+            key: base[key] if value is None else value
+            for key, value in custom.items()}}
+
+    memory = importlib.import_module(addon.__name__ + '.mixin.dasar.memory')
+    results = {}
+    for name, params in scenarios.items():
+        results[name] = run_scenario(addon, name, params, options)
+        print('{:>8}: {:.3f}s, peak {:.1f} MB, RSS {}, {:.1f} MB file'.format(
+            name, results[name]['time'], results[name]['peak'] / 1024 ** 2,
+            memory.format_size(results[name]['peak_rss']), results[name]['size'] / 1024 ** 2))
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({
+                'blender': bpy.app.version_string,
+                'geom_engine': options.geom_engine,
+                'scenarios': results,
+            }, f, indent=4)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if compare_results(results, baseline, options.tolerance):
+            sys.exit(1)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    geom = commands.add_parser('geom', help='compare geometry engines')
+    geom.add_argument('--triangles', type=int, default=200000)
+
+    tangents = commands.add_parser('tangents', help='compare tangent extraction memory')
+    tangents.add_argument('--triangles', type=int, default=200000)
+    tangents.add_argument('--uv-layers', type=int, default=4)
+
+    armature = commands.add_parser('armature', help='time the export of a hair rig')
+    armature.add_argument('--bones', type=int, default=1500)
+
+    triangles = commands.add_parser('triangles', help='compare triangulation memory')
+    triangles.add_argument('--faces', type=int, default=500000)
+
+    suite = commands.add_parser('suite', help='export synthetic avatars, save or compare a baseline')
+    suite.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    suite.add_argument('--triangles', type=int, help='custom scenario, other sizes from small')
+    suite.add_argument('--shape-keys', type=int)
+    suite.add_argument('--uv-layers', type=int)
+    suite.add_argument('--spring-bones', type=int)
+    suite.add_argument('--actions', type=int)
+    suite.add_argument('--geom-engine', choices=('python', 'numpy'), default='numpy')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--save', help='write results to a baseline JSON')
+    suite.add_argument('--compare', help='baseline JSON, exit code 1 on regressions')
+    suite.add_argument('--tolerance', type=float, default=0.1, help='allowed growth of a metric')
+
+    options = parser.parse_args(argv)
+    addon = load_addon()
+
+    if options.command == 'geom':
+        bench_geom(addon, options)
+    elif options.command == 'tangents':
+        bench_tangents(addon, options)
+    elif options.command == 'armature':
+        bench_armature(addon, options)
+    elif options.command == 'triangles':
+        bench_triangles(addon, options)
+    elif options.command == 'suite':
+        bench_suite(addon, options)
+
+
+if __name__ == '__main__':
+    main(sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else [])
@@ -16,124 +16,487 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import bpy
-import io
+import hashlib
+import numpy as np
 import os
+import shutil
 import struct
+import tempfile
 
 #from . import spec
 from .mixin.dasar import spec
+from .mixin.dasar.memory import format_size
+
+
+TYPE_SIZES = {
+    'SCALAR': 1,
+    'VEC2': 2,
+    'VEC3': 3,
+    'VEC4': 4,
+    'MAT4': 4 * 4,
+}
+
+NUMPY_TYPES = {
+    spec.TYPE_BYTE: '<i1',
+    spec.TYPE_UNSIGNED_BYTE: '<u1',
+    spec.TYPE_SHORT: '<i2',
+    spec.TYPE_UNSIGNED_SHORT: '<u2',
+    spec.TYPE_UNSIGNED_INT: '<u4',
+    spec.TYPE_FLOAT: '<f4',
+}
+
+# chunk size for copying image files into the buffer
+COPY_SIZE = 1024 * 1024
+
+# the largest byteStride allowed by the glTF spec
+MAX_STRIDE = 252
+
+
+def padding(size, alignment=4):
+    """
+    Returns bytes count to pad size up to alignment.
+    """
+    return -size % alignment
 
 
 class GLTFBuffer(object):
+    # initial channel capacity in bytes, grows twice when full
+    INITIAL_CAPACITY = 1024
+
     def __init__(self, filepath):
         self._filepath = filepath
-        self._channels = []
+        self._channels = []  # preallocated bytearrays
+        self._lengths = []  # used bytes of channels
+        self._structs = []  # compiled element formats of channels
         self._metadata = []
+        self._sparse = {}  # channel id -> max fraction of non-zero elements
+        self._strides = {}  # channel id -> bytes per padded element
+        self._targets = {}  # channel id -> target hint of the buffer view
+        self._interleaved = {}  # channel id -> channel ids sharing a buffer view
+        self._spill_file = None  # temporary file with channels moved out of memory
+        self._spilled = {}  # channel id -> offset in the spill file
+        self._spill_size = 0  # bytes written to the spill file
+
+    @staticmethod
+    def _make_struct(metadata):
+        return struct.Struct('<{}'.format(
+            np.dtype(NUMPY_TYPES[metadata['componentType']]).char *
+            TYPE_SIZES[metadata['type']]))
 
     def add_channel(self, metadata):
-        self._channels.append(io.BytesIO())
+        self._channels.append(bytearray(self.INITIAL_CAPACITY))
+        self._lengths.append(0)
+        self._structs.append(self._make_struct(metadata))
         self._metadata.append(metadata)
         self._metadata[-1]['bufferView'] = len(self._metadata) - 1
         self._metadata[-1]['count'] = 0
         return self._metadata[-1]
 
+    def _reserve(self, channel_id, size):
+        """
+        Make room for size bytes at the channel end, returns write offset.
+        """
+        if channel_id in self._spilled:
+            self._unspill(channel_id)
+
+        channel = self._channels[channel_id]
+        offset = self._lengths[channel_id]
+        if offset + size > len(channel):
+            # reallocate instead of resize, arrays from read_array may still
+            # refer to the old memory
+            grown = bytearray(max(offset + size, len(channel) * 2))
+            grown[:offset] = memoryview(channel)[:offset]
+            self._channels[channel_id] = grown
+        self._lengths[channel_id] = offset + size
+        return offset
+
     def write(self, channel_id, *values):
-        size = {
-            'SCALAR': 1,
-            'VEC2': 2,
-            'VEC3': 3,
-            'VEC4': 4,
-            'MAT4': 4 * 4,
-        }[self._metadata[channel_id]['type']]
-        assert size == len(values)
-
-        type_ = {
-            spec.TYPE_UNSIGNED_BYTE: 'B',
-            spec.TYPE_UNSIGNED_SHORT: 'H',
-            spec.TYPE_UNSIGNED_INT: 'I',
-            spec.TYPE_FLOAT: 'f',
-        }[self._metadata[channel_id]['componentType']]
-
-        format_ = '<{}'.format(type_ * size)
-
-        self._channels[channel_id].write(struct.pack(format_, *values))
+        """
+        Write a single element. Prefer write_array for many elements.
+        """
+        struct_ = self._structs[channel_id]
+        offset = self._reserve(channel_id, struct_.size)
+        struct_.pack_into(self._channels[channel_id], offset, *values)
         self._metadata[channel_id]['count'] += 1
 
+    def write_array(self, channel_id, array):
+        """
+        Write a whole (count x components) array to the channel at once.
+        Accepts numpy arrays, array.array or any sequence.
+        """
+        metadata = self._metadata[channel_id]
+        size = TYPE_SIZES[metadata['type']]
+        array = np.ascontiguousarray(
+            array, dtype=NUMPY_TYPES[metadata['componentType']]).reshape(-1, size)
+
+        offset = self._reserve(channel_id, array.nbytes)
+        self._channels[channel_id][offset:offset + array.nbytes] = memoryview(array).cast('B')
+        metadata['count'] += len(array)
+
+    def read_array(self, channel_id):
+        """
+        Get channel data as (count x components) array.
+        """
+        metadata = self._metadata[channel_id]
+        dtype = np.dtype(NUMPY_TYPES[metadata['componentType']])
+        size = TYPE_SIZES[metadata['type']]
+        data = self.getbuffer(channel_id)
+        if channel_id in self._strides:  # drop the padding
+            data = np.frombuffer(data, dtype=np.uint8).reshape(
+                -1, self._strides[channel_id])[:, :dtype.itemsize * size].copy()
+        return np.frombuffer(data, dtype=dtype).reshape(-1, size)
+
+    def rewrite(self, channel_id, array, component_type=None,
+                normalized=False, stride=None, bounds=False):
+        """
+        Replace all channel data, optionally with another component type.
+        Elements are padded to stride bytes, vertex attributes have to be
+        aligned to 4 bytes, the stride of the channel is kept by default.
+        Bounds sets min and max of the accessor.
+        """
+        metadata = self._metadata[channel_id]
+        if component_type is not None:
+            metadata['componentType'] = component_type
+            self._structs[channel_id] = self._make_struct(metadata)
+        if normalized:
+            metadata['normalized'] = True
+
+        size = TYPE_SIZES[metadata['type']]
+        array = np.ascontiguousarray(
+            array, dtype=NUMPY_TYPES[metadata['componentType']]).reshape(-1, size)
+        if bounds and len(array):
+            metadata['min'] = array.min(axis=0).tolist()
+            metadata['max'] = array.max(axis=0).tolist()
+
+        data = array.view(np.uint8).reshape(len(array), -1)
+        stride = stride or self._strides.get(channel_id)
+        if stride:
+            padded = np.zeros((len(array), stride), dtype=np.uint8)
+            padded[:, :data.shape[1]] = data
+            data = padded
+            self._strides[channel_id] = stride
+
+        self._spilled.pop(channel_id, None)
+        self._channels[channel_id] = bytearray(data.tobytes())
+        self._lengths[channel_id] = len(self._channels[channel_id])
+        metadata['count'] = len(array)
+
+    def getbuffer(self, channel_id):
+        """
+        Get used channel bytes as memoryview, without copying.
+        Spilled channels are read from the spill file.
+        """
+        if channel_id in self._spilled:
+            self._spill_file.seek(self._spilled[channel_id])
+            return memoryview(self._spill_file.read(self._lengths[channel_id]))
+        return memoryview(self._channels[channel_id])[:self._lengths[channel_id]]
+
+    def memory_size(self):
+        """
+        Returns bytes allocated by the channels kept in memory.
+        """
+        return sum(len(channel) for channel in self._channels)
+
+    def spill(self):
+        """
+        Move used bytes of all channels to the temporary spill file
+        and free their memory. Channels are loaded back on the next write.
+        Returns moved bytes count.
+        """
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile()
+
+        moved = 0
+        self._spill_file.seek(0, os.SEEK_END)
+        for i, channel in enumerate(self._channels):
+            if i in self._spilled or not len(channel):
+                continue
+            self._spilled[i] = self._spill_file.tell()
+            self._spill_file.write(memoryview(channel)[:self._lengths[i]])
+            self._channels[i] = bytearray()
+            moved += self._lengths[i]
+
+        self._spill_size += moved
+        return moved
+
+    def _unspill(self, channel_id):
+        channel = bytearray(max(self._lengths[channel_id], self.INITIAL_CAPACITY))
+        channel[:self._lengths[channel_id]] = self.getbuffer(channel_id)
+        self._channels[channel_id] = channel
+        del self._spilled[channel_id]  # the old copy is left in the file
+
+    def get_spill_size(self):
+        return self._spill_size
+
+    def close(self):
+        """
+        Remove the spill file.
+        """
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+            self._spilled = {}
+
+    def set_sparse(self, channel_id, threshold):
+        """
+        Export the channel as sparse accessor, when the fraction
+        of non-zero elements is under the threshold.
+        """
+        self._sparse[channel_id] = threshold
+
+    def get_sparse(self, channel_id):
+        """
+        Returns (indices, values) of the non-zero elements,
+        None if the channel should be exported dense.
+        """
+        if channel_id not in self._sparse:
+            return None
+
+        array = self.read_array(channel_id)
+        indices = np.flatnonzero(np.any(array != 0, axis=1))
+        if len(indices) >= self._sparse[channel_id] * len(array):
+            return None
+
+        if len(array) > 0xffff:
+            indices = indices.astype(NUMPY_TYPES[spec.TYPE_UNSIGNED_INT])
+        else:
+            indices = indices.astype(NUMPY_TYPES[spec.TYPE_UNSIGNED_SHORT])
+        return indices, np.ascontiguousarray(array[indices])
+
+    def set_target(self, channel_id, target):
+        """
+        Set the target hint of the channel buffer view,
+        spec.ARRAY_BUFFER or spec.ELEMENT_ARRAY_BUFFER.
+        """
+        self._targets[channel_id] = target
+
+    def interleave(self, channel_ids):
+        """
+        Export vertex attribute channels in one buffer view, element
+        after element with byteStride. Channels need the same count,
+        sparse and already interleaved channels are left out.
+        Returns False if the channels can't be interleaved.
+        """
+        channel_ids = [
+            i for i in channel_ids
+            if i not in self._sparse and i not in self._interleaved]
+        if len(channel_ids) < 2 or len(set(map(self.count, channel_ids))) != 1:
+            return False
+        if not self.count(channel_ids[0]):
+            return False
+
+        sizes = [
+            self._strides.get(i) or self._structs[i].size for i in channel_ids]
+        if sum(size + padding(size) for size in sizes) > MAX_STRIDE:
+            return False
+
+        for i in channel_ids:
+            self._interleaved[i] = channel_ids
+            self._targets[i] = spec.ARRAY_BUFFER
+        return True
+
+    def _make_interleaved(self, channel_ids):
+        """
+        Returns interleaved bytes of the channels as (count x stride) array
+        and offset of every channel in the element. Vertex attributes
+        are aligned to 4 bytes.
+        """
+        columns = []
+        offsets = []
+        stride = 0
+        for i in channel_ids:
+            data = np.frombuffer(self.getbuffer(i), dtype=np.uint8).reshape(self.count(i), -1)
+            size = data.shape[1]
+            offsets.append(stride)
+            columns.append(data)
+            if padding(size):
+                columns.append(np.zeros((len(data), padding(size)), dtype=np.uint8))
+            stride += size + padding(size)
+        return np.hstack(columns), offsets
+
     def write_raw(self, channel_id, data):
-        self._channels[channel_id].write(data)
+        offset = self._reserve(channel_id, len(data))
+        self._channels[channel_id][offset:offset + len(data)] = data
         self._metadata[channel_id]['count'] += len(data)
 
     def count(self, channel_id):
         return self._metadata[channel_id]['count']
 
-    def export(self, parent_node, filepath=None):
+    def _hash_part(self, part):
+        """
+        Content hash of a part placed by layout.
+        """
+        digest = hashlib.sha1()
+        if isinstance(part, str):
+            with open(part, 'rb') as image:
+                for data in iter(lambda: image.read(COPY_SIZE), b''):
+                    digest.update(data)
+        elif isinstance(part, tuple):  # (offset, size) in the spill file
+            self._spill_file.seek(part[0])
+            left = part[1]
+            while left:
+                data = self._spill_file.read(min(left, COPY_SIZE))
+                digest.update(data)
+                left -= len(data)
+        else:
+            digest.update(part)
+        return digest.digest()
+
+    def layout(self, parent_node):
+        """
+        Add accessors and buffer views of channels and embedded images
+        to the glTF data. Nothing is copied, the parts are kept for write_to.
+        Parts with the same bytes share one buffer view, except vertex
+        attributes without byteStride, which can't share it.
+        Returns full buffer size, with padding.
+        """
         offset = 0
-        data = bytearray()
-        uri = 'nothing.bin'
+        self._parts = []
+        views = {}  # (hash, size, stride, target) -> buffer view id
+        shared = 0
+        saved = 0
 
-        # accessors + buffer views
-        for i in range(len(self._channels)):
-            channel = self._channels[i]
-            metadata = self._metadata[i]
-            extras = metadata.get('extras') or {}
-            parent_node['accessors'].append(metadata)
+        # accessors are added in the channel order
+        vertex_channels = {
+            channel_id
+            for gltf_mesh in parent_node.get('meshes', [])
+            for gltf_primitive in gltf_mesh['primitives']
+            for attributes in [gltf_primitive['attributes']] + gltf_primitive.get('targets', [])
+            for channel_id in attributes.values()}
+
+        def add_view(part, size, extras, stride=None, target=None, can_share=True):
+            nonlocal offset, shared, saved
+            key = None
+            if can_share:
+                key = (self._hash_part(part), size, stride, target)
+            if key in views:
+                shared += 1
+                saved += size + padding(size)
+                return views[key]
 
-            part = channel.getbuffer()
             view = {
                 'buffer': len(parent_node['buffers']),
-                'byteLength': len(part),
+                'byteLength': size,
                 'byteOffset': offset,
                 'extras': extras,
             }
+            if stride:
+                view['byteStride'] = stride
+            if target:
+                view['target'] = target
             parent_node['bufferViews'].append(view)
+            self._parts.append((part, size, padding(size)))
+            offset += size + padding(size)
+            if key is not None:
+                views[key] = len(parent_node['bufferViews']) - 1
+            return len(parent_node['bufferViews']) - 1
+
+        # accessors + buffer views
+        for i in range(len(self._channels)):
+            metadata = self._metadata[i]
+            extras = metadata.get('extras') or {}
+            parent_node['accessors'].append(metadata)
 
-            offset += len(part)
-            data += part
+            if i in self._interleaved:
+                channel_ids = self._interleaved[i]
+                if i == channel_ids[0]:  # the view is made with the first channel
+                    data, offsets = self._make_interleaved(channel_ids)
+                    view_id = add_view(
+                        data, data.nbytes, extras, data.shape[1], spec.ARRAY_BUFFER)
+                    for channel_id, channel_offset in zip(channel_ids, offsets):
+                        self._metadata[channel_id]['bufferView'] = view_id
+                        if channel_offset:
+                            self._metadata[channel_id]['byteOffset'] = channel_offset
+                continue
+
+            sparse = self.get_sparse(i)
+            if sparse is None:
+                if i in self._spilled:  # copied from the spill file by write_to
+                    part = (self._spilled[i], self._lengths[i])
+                else:
+                    part = self.getbuffer(i)
+                metadata['bufferView'] = add_view(
+                    part, self._lengths[i], extras,
+                    self._strides.get(i), self._targets.get(i),
+                    can_share=i not in vertex_channels or i in self._strides)
+                continue
+
+            # accessor without buffer view is initialized with zeros
+            del metadata['bufferView']
+            indices, values = sparse
+            if len(indices):
+                metadata['sparse'] = {
+                    'count': len(indices),
+                    'indices': {
+                        'bufferView': add_view(indices, indices.nbytes, extras),
+                        'componentType': (
+                            spec.TYPE_UNSIGNED_INT if indices.dtype.itemsize == 4
+                            else spec.TYPE_UNSIGNED_SHORT),
+                    },
+                    'values': {
+                        'bufferView': add_view(values, values.nbytes, extras),
+                    },
+                }
 
         # embedded images + buffer views
         for gltf_image in parent_node.get('images', []):
             extras = gltf_image.get('extras') or {}
 
             part = None
+            size = 0
 
             if 'uri' in extras:
                 #tfilepath = os.path.join(os.path.dirname(self._filepath), extras['uri'])
-                tfilepath = extras['uri']
-                with open(tfilepath, 'rb') as f:
-                    part = f.read()
+                part = extras['uri']  # copied from the file by write_to
+                size = os.path.getsize(part)
 
             elif 'data' in extras:
                 part = extras.pop('data')
+                size = len(part)
 
-            if not part:
+            if not size:
                 continue
 
-            view = {
-                'buffer': len(parent_node['buffers']),
-                'byteLength': len(part),
-                'byteOffset': offset,
-                'extras': extras,
-            }
-            parent_node['bufferViews'].append(view)
-            gltf_image['bufferView'] = len(parent_node['bufferViews']) - 1
+            gltf_image['bufferView'] = add_view(part, size, extras)
+
+        if shared:
+            print('buffer views: {} shared, {} saved'.format(shared, format_size(saved)))
+
+        if offset:
+            parent_node['buffers'].append({
+                'byteLength': offset,
+            })
+
+        return offset
 
-            offset += len(part)
-            data += part
+    def write_to(self, f):
+        """
+        Write parts of the buffer, placed by layout, to the file.
+        """
+        for part, size, pad in self._parts:
+            if isinstance(part, str):
+                with open(part, 'rb') as image:
+                    shutil.copyfileobj(image, f, COPY_SIZE)
+            elif isinstance(part, tuple):  # (offset, size) in the spill file
+                self._spill_file.seek(part[0])
+                left = part[1]
+                while left:
+                    data = self._spill_file.read(min(left, COPY_SIZE))
+                    f.write(data)
+                    left -= len(data)
+            else:
+                f.write(part)
+            f.write(bytes(pad))
 
-        if filepath:
+    def export(self, parent_node, filepath=None):
+        size = self.layout(parent_node)
+
+        if filepath and size:
             buffer_fp = filepath.replace('.gltf', '.bin')
             with open(buffer_fp, 'wb') as f:
-                f.write(data)
+                self.write_to(f)
 
-            uri = bpy.path.relpath(
+            parent_node['buffers'][-1]['uri'] = bpy.path.relpath(
                 buffer_fp, bpy.path.dirname(self._filepath))
 
-        if len(data):
-            gltf_buffer = {
-                'byteLength': len(data),
-            }
-            if filepath:
-                gltf_buffer['uri'] = uri
-            parent_node['buffers'].append(gltf_buffer)
-
-        return data
+        return size
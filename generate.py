@@ -305,11 +305,44 @@ class cek_struktur_rig(bpy.types.Operator):
 
         return {'FINISHED'}
 
+def get_export_objects(context, dmta):
+    """
+    Returns (allowed, disabled) objects: the main rig, the main model,
+    their children and the other objects of the view layer.
+    """
+    rig = dmta.rig
+    model = dmta.model
+    semua_obj = context.scene.objects
+    anakan_rig = rig.children_recursive
+    anakan_model = model.children_recursive
+    vl = context.view_layer.objects
+
+    #memilah object yang tidak ikut
+    list1_1 = list(obj for obj in semua_obj)
+    list1_2 = list(obj for obj in vl)
+    list1_3 = [item for item in list1_1 if item not in list1_2]
+
+    list2_1 = [rig, model]
+    list2_2 = [item for item in list1_2 if item not in list2_1]
+    list2_3 = [item for item in list2_2 if item not in anakan_rig]
+    list2_4 = [item for item in list2_3 if item not in anakan_model]
+
+    list_obj_dis = list1_3 + list2_4
+    list_obj_allow = [item for item in list1_1 if item not in list_obj_dis]
+    return list_obj_allow, list_obj_dis
+
 class buat_mhv(bpy.types.Operator):
     bl_idname = "obj.generate_mhv"
     bl_label = "Generate Preexport"
     bl_options = {'REGISTER', 'UNDO'}
     
+    prepare : bpy.props.BoolProperty(
+        name= "Prepare",
+        description= "Apply transforms and hide the other objects, only check the objects when disabled",
+        default= True,
+        options= {'SKIP_SAVE'}
+    )
+    
     def persiapkan(self, context, dmta, rig, model, semua_obj, anakan_rig, anakan_model, vl, list_obj_dis, list_obj_allow):
 #        print (" ")
 #        print ("mempersiapkan")
@@ -371,17 +404,7 @@ class buat_mhv(bpy.types.Operator):
         vl = bpy.context.view_layer.objects
                 
         #memilah object yang tidak ikut
-        list1_1 = list(obj for obj in semua_obj)
-        list1_2 = list(obj for obj in vl)
-        list1_3 = [item for item in list1_1 if item not in list1_2]
-        
-        list2_1 = [rig, model]
-        list2_2 = [item for item in list1_2 if item not in list2_1]
-        list2_3 = [item for item in list2_2 if item not in anakan_rig]
-        list2_4 = [item for item in list2_3 if item not in anakan_model]
-        
-        list_obj_dis = list1_3 + list2_4
-        list_obj_allow = [item for item in list1_1 if item not in list_obj_dis]
+        list_obj_allow, list_obj_dis = get_export_objects(bpy.context, dmta)
 
 #        print ("list1_3",list1_3)
 #        print (" ")
@@ -429,7 +452,7 @@ class buat_mhv(bpy.types.Operator):
                         dmta.amwsk_gagal = True
 
         #fungsi dijalankan apabila lengkap
-        if dmta.find_obj and dmta.find_rig and dmta.find_model and dmta.find_bone and dmta.find_parent:
+        if self.prepare and dmta.find_obj and dmta.find_rig and dmta.find_model and dmta.find_bone and dmta.find_parent:
             bpy.ops.object.mode_set(mode='OBJECT')
             for obj in semua_obj:
                 obj.hide_set(False)
@@ -25,31 +25,34 @@ import struct
 from bpy_extras.io_utils import ExportHelper
 from typing import Set, cast
 
-from .mixin.dasar.armature import get_armature
-from .mixin.dasar.context import Mode
-from .mixin.dasar.collections import get_object_collection
+from .mixin.dasar.cache import DiskCache
+from .mixin.dasar.context import Mode, NoArmatureDeform
+from .mixin.dasar.document import GLTFDocument
+from .mixin.dasar.memory import format_size, get_peak_rss
 from .mixin.dasar.matrices import (
-    get_bone_matrix, get_object_matrix, get_inverse_bind_matrix,
-    matrix_to_list, quat_to_list)
-from .mixin.dasar.objects import (
-    is_collision, is_object_visible, get_object_properties, set_active_object)
+    get_object_matrix, matrix_to_list, quat_to_list)
+from .mixin.dasar.objects import set_active_object
 
 #from . import spec
 from .mixin.dasar import spec
+from .impread.write.dasar.g2_debug import profile_stage, profiled
 
 
-from .buffer import GLTFBuffer
-from .mixin.animation import AnimationMixin
+from .buffer import GLTFBuffer, padding
+from .mixin.animation import BAKE_CACHE_SIZE, AnimationMixin
 from .mixin.geom import GeomMixin
+from .mixin.geom_numpy import NumpyGeomMixin
 from .mixin.material import MaterialMixin
+from .mixin.optimize import OptimizeMixin
+from .mixin.quantize import QuantizeMixin
 from .mixin.vertex import VertexMixin
-from .mixin.texture import TextureMixin
+from .mixin.texture import TEXTURE_CACHE_SIZE, TextureMixin
 
 from .mixin.exportersetings import Exporter
 
 
-class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
-                   VertexMixin, TextureMixin, Exporter):
+class GLTFExporter(AnimationMixin, NumpyGeomMixin, GeomMixin, MaterialMixin,
+                   OptimizeMixin, QuantizeMixin, VertexMixin, TextureMixin, Exporter):
     """
     BLEND to GLTF converter.
     """
@@ -60,6 +63,37 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
         self._pose_freeze = getattr(args, 'pose_freeze', False)
         self._split_primitives = getattr(args, 'split_primitives', False)
         self._norm_weights = getattr(args, 'normalize_weights', False)
+        self._geom_engine = getattr(args, 'geom_engine', None) or 'python'
+        self._bake_engine = getattr(args, 'bake_engine', None) or 'scene'
+        self._key_tolerance = getattr(args, 'key_tolerance', None) or 0
+        self._sparse_targets = getattr(args, 'sparse_targets', None) or 0
+        self._joint_layers = getattr(args, 'joint_layers', None) or 1  # 4 joints per layer
+        self._quantize = getattr(args, 'quantize', False)  # KHR_mesh_quantization
+        self._vertex_cache = getattr(args, 'vertex_cache', False)  # reorder triangles and vertices
+        self._interleave = getattr(args, 'interleave', False)  # vertex attributes in one buffer view
+        self._instance_meshes = getattr(args, 'instance_meshes', False)  # share meshes of linked duplicates
+        self._mesh_instances = {}  # get_instance_key -> mesh id
+        self._null_targets = set()  # names of skipped shape keys
+        self._evaluated = getattr(args, 'evaluated', False)  # don't change the scene
+        self._geom_meshes = []  # objects with mesh copies to free
+        self._keyed_meshes = {}  # object name -> mesh made by get_instance_key
+        stream_memory = getattr(args, 'stream_memory', None)  # MB, None keeps buffers in memory
+        self._stream_memory = None if stream_memory is None else stream_memory * 1024 ** 2
+
+        self._bake_cache = None
+        if getattr(args, 'bake_cache', None):
+            self._bake_cache = DiskCache(
+                args.bake_cache,
+                getattr(args, 'bake_cache_size', None) or BAKE_CACHE_SIZE)
+
+        self._texture_cache = None
+        if getattr(args, 'texture_cache', None):
+            self._texture_cache = DiskCache(
+                args.texture_cache,
+                getattr(args, 'texture_cache_size', None) or TEXTURE_CACHE_SIZE)
+        self._texture_max_size = getattr(args, 'texture_max_size', None) or 0
+        self._texture_png = getattr(args, 'texture_png', None) or 'KEEP'
+        self._texture_jpeg_quality = getattr(args, 'texture_jpeg_quality', None) or 0
 
         if self._z_up:
             self._matrix = mathutils.Matrix((
@@ -102,8 +136,47 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
         pos = matrix.to_translation()
         return mathutils.Matrix.Translation(pos).to_4x4()
 
+    def _get_rest_matrix(self, bone, armature):
+        """
+        Bone rest matrix in the armature space. Pose freeze resets bones
+        rotation in edit mode and the pre-export applies the armature
+        transform, the evaluated export makes the same matrix instead
+        of changing the armature.
+        """
+        if not self._evaluated:
+            return bone.matrix_local
+
+        matrix = armature.matrix_local @ bone.matrix_local
+        if self._pose_freeze:
+            return mathutils.Matrix.Translation(matrix.to_translation())
+        return (
+            mathutils.Matrix.Translation(matrix.to_translation()) @
+            matrix.to_quaternion().to_matrix().to_4x4())
+
+    def _get_bone_rest(self, bone, armature):
+        """
+        Bone rest matrix in the parent bone space, like get_bone_matrix.
+        """
+        if bone.parent:
+            return (
+                self._get_rest_matrix(bone.parent, armature).inverted() @
+                self._get_rest_matrix(bone, armature))
+        return self._get_rest_matrix(bone, armature)
+
+    def _get_pose_matrix(self, pose_bone, armature):
+        """
+        Pose bone matrix in the armature space, relative to the rest
+        matrix made by _get_rest_matrix.
+        """
+        if not self._evaluated:
+            return pose_bone.matrix
+        return (
+            self._get_rest_matrix(pose_bone.bone, armature) @
+            pose_bone.bone.matrix_local.inverted() @
+            pose_bone.matrix)
+
     def make_root_node(self):
-        gltf_node = {
+        gltf_node = GLTFDocument({
             'asset': {
                 'generator': (
                     'VRM Exporter by TRPHB Animation - https://github.com/Roni-Raihan/VRM-Convert-Addon-blender'
@@ -136,7 +209,7 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
             'accessors': [],
             'bufferViews': [],
             'buffers': [],
-        }
+        })
 
         if self._z_up:
             gltf_node['extensionsUsed'].append('BP_zup')
@@ -144,8 +217,7 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
         return gltf_node
 
     def _add_child(self, parent_node, child_node):
-        self._root['nodes'].append(child_node)
-        node_id = len(self._root['nodes']) - 1
+        node_id = self._root.add('nodes', child_node)
 
         if 'scenes' in parent_node:
             self._root['scenes'][0]['nodes'].append(node_id)
@@ -156,13 +228,18 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
         if obj is None:
             return
 
-        armature = get_armature(obj)
+        armature = self._scene.get_armature(obj)
         obj_matrix = self._transform(get_object_matrix(obj, armature=armature))
 
         # get custom object properties
-        obj_props = get_object_properties(obj)
+        obj_props = self._scene.get_properties(obj)
 
-        if not can_merge and not armature:
+        # the evaluated export applies the armature transform to the bones
+        has_transform = not can_merge and not armature
+        if self._evaluated and obj.type == 'ARMATURE':
+            has_transform = False
+
+        if has_transform:
             if self._geom_scale == 1:
                 node.update({
                     'rotation': quat_to_list(obj_matrix.to_quaternion()),
@@ -182,7 +259,7 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
                 })
 
         # setup collisions
-        if not can_merge and is_collision(obj) and obj_props.get('type') != 'Portal':
+        if not can_merge and self._scene.is_collision(obj) and obj_props.get('type') != 'Portal':
             collision = {}
             node['extensions'] = {
                 'BLENDER_physics': collision,
@@ -265,7 +342,7 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
             'joints': [],
             'inverseBindMatrices': channel['bufferView'],
         }
-        self._root['skins'].append(gltf_skin)
+        self._root.add('skins', gltf_skin)
 
         set_active_object(armature)
 
@@ -274,11 +351,18 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
             bone_tails_local[bone_name] = bone.tail
 
         bone_tails_off = {}
-        with Mode('EDIT'):
-            for bone_name, bone in armature.data.edit_bones.items():
-                bone_tails_off[bone_name] = bone.tail - bone.head
+        if self._evaluated:  # the same as edit bones, without edit mode
+            rotation = armature.matrix_local.to_3x3()
+            for bone_name, bone in armature.data.bones.items():
+                bone_tails_off[bone_name] = rotation @ (bone.tail_local - bone.head_local)
+                if not bone.parent:
+                    bone_tails_local[bone_name] = armature.matrix_local @ bone.tail
+        else:
+            with Mode('EDIT'):
+                for bone_name, bone in armature.data.edit_bones.items():
+                    bone_tails_off[bone_name] = bone.tail - bone.head
 
-        if self._pose_freeze:
+        if self._pose_freeze and not self._evaluated:
             # set_active_object(armature)
 
             # disconnect all bones
@@ -297,7 +381,7 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
         # create joint nodes
         gltf_joints = {}
         for bone_name, bone in armature.data.bones.items():
-            bone_matrix = self._transform(get_bone_matrix(bone, armature))
+            bone_matrix = self._transform(self._get_bone_rest(bone, armature))
             bone_tail_matrix = self._transform(
                 mathutils.Matrix.Translation(bone_tails_local[bone_name]))
 
@@ -328,7 +412,11 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
             else:  # attach joint to armature
                 self._add_child(gltf_armature, gltf_joints[bone.name])
 
-            ib_matrix = self._transform(get_inverse_bind_matrix(bone, armature))
+            # the evaluated export has the armature transform in the rest matrices
+            ib_matrix = self._get_rest_matrix(bone, armature).inverted()
+            if self._evaluated:
+                ib_matrix = ib_matrix @ armature.matrix_local
+            ib_matrix = self._transform(ib_matrix @ armature.matrix_world.inverted())
             if self._pose_freeze:
                 ib_matrix = self._freeze(ib_matrix)
 
@@ -341,7 +429,7 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
         self._add_child(parent_node, gltf_armature)
 
         # no meshes or animation only
-        if (not list(filter(is_object_visible, armature.children)) or
+        if (not list(filter(self._scene.is_visible, self._scene.get_children(armature))) or
                 self._export_type == 'animation'):
             gltf_child_node = {
                 'name': '{}_EMPTY'.format(armature.name),
@@ -351,9 +439,10 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
 
         return gltf_armature
 
-    def _make_node_mesh(self, parent_node, name, obj=None, can_merge=False):
+    def _make_node_mesh(self, parent_node, name, obj=None, can_merge=False, mesh_id=None):
         """
         Make glTF-node - glTF-mesh pair for chosen Blender object.
+        The node refers to mesh_id instead, when the mesh is shared.
         """
         gltf_node = {
             'name': name,
@@ -371,7 +460,9 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
             elif obj.rigid_body.collision_shape == 'MESH':
                 need_mesh = True
 
-        if need_mesh:
+        if need_mesh and mesh_id is not None:
+            gltf_node['mesh'] = mesh_id
+        elif need_mesh:
             gltf_mesh = {
                 'name': name,
                 'primitives': [],
@@ -379,15 +470,13 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
                     'targetNames': [],
                 },
             }
-            self._root['meshes'].append(gltf_mesh)
-            gltf_node['mesh'] = len(self._root['meshes']) - 1
+            gltf_node['mesh'] = self._root.add('meshes', gltf_mesh)
 
-        armature = obj and get_armature(obj)
+        armature = obj and self._scene.get_armature(obj)
         if armature:
-            for i, gltf_skin in enumerate(self._root['skins']):
-                if gltf_skin['name'] == armature.name:
-                    gltf_node['skin'] = i
-                    break
+            skin_id = self._root.find('skins', armature.name)
+            if skin_id is not None:
+                gltf_node['skin'] = skin_id
 
         self._setup_node(gltf_node, obj, can_merge=can_merge)
         self._add_child(parent_node, gltf_node)
@@ -410,7 +499,7 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
         # merged nodes
         # if self.can_merge(obj):
         if False:
-            collection = get_object_collection(obj)
+            collection = self._scene.get_collection(obj)
 
             for child in self._root['nodes']:
                 if child['name'] == collection.name:
@@ -428,11 +517,13 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
 
             if gltf_mesh:
                 self.make_geom(gltf_node, gltf_mesh, obj, can_merge=True)
+                self.free_geom_meshes()
+                self.stream_buffer(obj.name)
 
         # separate nodes
         # if not self.can_merge(obj) or self._keep:
         if True:
-            obj_props = get_object_properties(obj)
+            obj_props = self._scene.get_properties(obj)
             if obj_props.get('type') == 'Portal':
                 vertices = [list(vertex.co) for vertex in obj.data.vertices]
                 gltf_node = {
@@ -443,11 +534,26 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
                 self._add_child(parent_node, gltf_node)
                 return gltf_node
 
+            # linked duplicates share the mesh of the first object
+            key = mesh_id = None
+            if self._instance_meshes:
+                key = self.get_instance_key(obj)
+                mesh_id = self._mesh_instances.get(key)
+                if mesh_id is not None:
+                    print('{}: shares mesh {}'.format(
+                        obj.name, self._root['meshes'][mesh_id]['name']))
+
             gltf_node, gltf_mesh = self._make_node_mesh(
-                parent_node, obj.name, obj, can_merge=False)
+                parent_node, obj.name, obj, can_merge=False, mesh_id=mesh_id)
 
             if gltf_mesh:
+                if key is not None:
+                    self._mesh_instances[key] = gltf_node['mesh']
                 self.make_geom(gltf_node, gltf_mesh, obj, can_merge=False)
+                self.free_geom_meshes()
+                self.stream_buffer(obj.name)
+            elif key is not None:
+                self.free_geom_meshes()  # the mesh hashed for the key
 
         return gltf_node
 
@@ -482,24 +588,62 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
 
         return gltf_light
 
+    def stream_buffer(self, name):
+        """
+        Move the buffer to the spill file when it's over the memory limit,
+        called after every object and action.
+        """
+        if self._stream_memory is None:
+            return
+        if self._buffer.memory_size() <= self._stream_memory:
+            return
+
+        moved = self._buffer.spill()
+        print('{}: {} of buffers moved to disk, peak memory {}'.format(
+            name, format_size(moved), format_size(get_peak_rss())))
+
     def convert(self):
         self._buffer = GLTFBuffer(self._output)
-        root = super().convert()
+        if self._evaluated:
+            with NoArmatureDeform():
+                root = super().convert()
+        else:
+            root = super().convert()
+
+        if self._vertex_cache:
+            self.optimize_meshes(root)
+        if self._quantize:
+            self.quantize_meshes(root)
+        if self._interleave:
+            self.interleave_meshes(root)
+
+        if self._stream_memory is not None:
+            print('buffers: {} in memory, {} on disk, peak memory {}'.format(
+                format_size(self._buffer.memory_size()),
+                format_size(self._buffer.get_spill_size()),
+                format_size(get_peak_rss())))
         return root, self._buffer
 
+    @profiled('file write')
     def write(self, root, output, is_binary=False):
         if is_binary:
-            with open(output, 'wb') as f:  # binary mode
-                chunk1 = self._buffer.export(root)  # export buffer first because it updates gltf data
-                chunk0 = json.dumps(root, indent=4).encode()  # export gltf data
+            self.embed_images(root)
+
+            # export buffer layout first because it updates gltf data
+            with profile_stage('buffer export'):
+                chunk1_size = self._buffer.layout(root)
+            chunk0 = json.dumps(root, separators=(',', ':')).encode()  # export gltf data
+            chunk0 += b' ' * padding(len(chunk0))  # JSON chunk is padded with spaces
 
+            with open(output, 'wb') as f:  # binary mode
                 # write global headers
                 f.write(b'glTF')  # header
                 f.write(struct.pack('<I', 2))  # version
                 size = (
                     4 + 4 + 4 +  # global headers
-                    4 + 4 + len(chunk0) +  # chunk0 + headers
-                    4 + 4 + len(chunk1))  # chunk1 + headers
+                    4 + 4 + len(chunk0))  # chunk0 + headers
+                if chunk1_size:
+                    size += 4 + 4 + chunk1_size  # chunk1 + headers
                 f.write(struct.pack('<I', size))  # full size
 
                 # write chunk0 with headers
@@ -507,11 +651,14 @@ class GLTFExporter(AnimationMixin, GeomMixin, MaterialMixin,
                 f.write(b'JSON')
                 f.write(chunk0)
 
-                # write chunk1 with headers
-                f.write(struct.pack('<I', len(chunk1)))
-                f.write(b'BIN\0')
-                f.write(chunk1)
+                # write chunk1 with headers, straight from the channels
+                if chunk1_size:
+                    f.write(struct.pack('<I', chunk1_size))
+                    f.write(b'BIN\0')
+                    self._buffer.write_to(f)
 
         else:
             with open(output, 'w') as f:  # text mode
                 json.dump(root, f, indent=4)
+
+        self._buffer.close()
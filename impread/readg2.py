@@ -30,7 +30,7 @@
 
 from .write.dasar.g2_path import uri_to_path
 from .write.dasar.g2 import gltf_from_dict
-from .write.dasar.g2_debug import Log
+from .write.dasar.g2_debug import Log, profile_stage
 import logging
 import json
 import struct
@@ -174,23 +174,25 @@ class glTFImporter():
         if not isfile(self.filename):
             raise ImportError("Please select a file")
 
-        with open(self.filename, 'rb') as f:
-            content = memoryview(f.read())
-
-        if content[:4] == b'glTF':
-            gltf, self.glb_buffer = self.load_glb(content)
-        else:
-            gltf = glTFImporter.load_json(content)
-            self.glb_buffer = None
-
-        glTFImporter.check_version(gltf)
-
-        try:
-            self.data = gltf_from_dict(gltf)
-        except AssertionError:
-            import traceback
-            traceback.print_exc()
-            raise ImportError("Couldn't parse glTF. Check that the file is valid")
+        with profile_stage('read'):
+            with open(self.filename, 'rb') as f:
+                content = memoryview(f.read())
+
+        with profile_stage('parse'):
+            if content[:4] == b'glTF':
+                gltf, self.glb_buffer = self.load_glb(content)
+            else:
+                gltf = glTFImporter.load_json(content)
+                self.glb_buffer = None
+
+            glTFImporter.check_version(gltf)
+
+            try:
+                self.data = gltf_from_dict(gltf)
+            except AssertionError:
+                import traceback
+                traceback.print_exc()
+                raise ImportError("Couldn't parse glTF. Check that the file is valid")
 
     def load_buffer(self, buffer_idx):
         """Load buffer."""
@@ -28,8 +28,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+import functools
+import json
 import time
 import logging
+import tracemalloc
 
 #
 # Globals
@@ -42,6 +46,7 @@ g_profile_started = False
 g_profile_start = 0.0
 g_profile_end = 0.0
 g_profile_delta = 0.0
+g_profiler = None
 
 #
 # Functions
@@ -126,6 +131,119 @@ def profile_end(label=None):
     print_console('PROFILE', output)
 
 
+class Profiler:
+    """Wall time, call count and tracemalloc peak of named stages."""
+
+    def __init__(self):
+        self.stages = {}  # name -> time, calls, peak
+        self.total = 0.0
+        self.peak = 0
+        self._running = []  # [name, start time, start memory, peak] of open stages
+        self._start = 0.0
+        self._tracing = False  # tracemalloc was started here
+
+    def start(self):
+        """Start the clock and memory tracing."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self._start = time.perf_counter()
+
+    def stop(self):
+        """Stop the clock, memory tracing is stopped if started here."""
+        self.total = time.perf_counter() - self._start
+        self._fold_peak()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def _fold_peak(self):
+        """Keep the traced peak in the open stages before it's reset."""
+        peak = tracemalloc.get_traced_memory()[1]
+        self.peak = max(self.peak, peak)
+        for stage in self._running:
+            stage[3] = max(stage[3], peak)
+        tracemalloc.reset_peak()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure the block, a stage inside itself is counted once."""
+        if any(stage[0] == name for stage in self._running):
+            yield
+            return
+
+        self._fold_peak()
+        stage = [name, time.perf_counter(), tracemalloc.get_traced_memory()[0], 0]
+        self._running.append(stage)
+        try:
+            yield
+        finally:
+            self._fold_peak()
+            self._running.remove(stage)
+            record = self.stages.setdefault(name, {'time': 0.0, 'calls': 0, 'peak': 0})
+            record['time'] += time.perf_counter() - stage[1]
+            record['calls'] += 1
+            record['peak'] = max(record['peak'], stage[3] - stage[2])
+
+    def print_stages(self):
+        """Print stages to Blender console at PROFILE level."""
+        for name, record in self.stages.items():
+            print_console('PROFILE', '{}: {:.3f}s, {} calls, peak {:.1f} MB'.format(
+                name, record['time'], record['calls'], record['peak'] / 1024 ** 2))
+        print_console('PROFILE', 'Total: {:.3f}s, peak {:.1f} MB'.format(
+            self.total, self.peak / 1024 ** 2))
+
+    def dump(self, filepath):
+        """Write the report as JSON, times in seconds and peaks in bytes."""
+        with open(filepath, 'w') as f:
+            json.dump({
+                'total': self.total,
+                'peak': self.peak,
+                'stages': self.stages,
+            }, f, indent=4)
+
+
+def set_profiler(profiler):
+    """Set the profiler of profile_stage, None disables profiling."""
+    global g_profiler
+
+    g_profiler = profiler
+
+
+def profile_stage(name):
+    """Context manager which measures a stage when profiling is enabled."""
+    if g_profiler is None:
+        return contextlib.nullcontext()
+    return g_profiler.stage(name)
+
+
+def profiled(name):
+    """Decorator which measures every call as a stage."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def profile_file(filepath):
+    """Profile the block and write the report to filepath."""
+    profiler = Profiler()
+    set_profiler(profiler)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        set_profiler(None)
+        profiler.print_stages()
+        profiler.dump(filepath)
+        print_console('PROFILE', 'Profile saved in: ' + filepath)
+
+
 # TODO: need to have a unique system for logging importer/exporter
 # TODO: this logger is used for importer, but in io and in blender part, but is written here in a _io_ file
 class Log:
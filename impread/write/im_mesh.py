@@ -31,7 +31,7 @@ import bpy
 from mathutils import Matrix
 import numpy as np
 from .dasar.g2_binary import import_user_extensions, BinaryData
-from .dasar.g2_debug import print_console
+from .dasar.g2_debug import print_console, profile_stage, profiled
 from .dasar.g2_constants import DataType, ComponentType
 from .dasar.g2b_conversion import get_attribute_type
 from .dasar.g2b_extras import set_extras
@@ -44,6 +44,7 @@ class BlenderMesh():
         raise RuntimeError("%s should not be instantiated" % cls)
 
     @staticmethod
+    @profiled('mesh creation')
     def create(gltf, mesh_idx, skin_idx):
         """Mesh creation."""
         return create_mesh(gltf, mesh_idx, skin_idx)
@@ -363,24 +364,25 @@ def do_primitives(gltf, mesh_idx, skin_idx, mesh, ob):
 
     # Skinning
     # TODO: this is slow :/
-    if num_joint_sets and mesh_options.skinning:
-        pyskin = gltf.data.skins[skin_idx]
-        for i, node_idx in enumerate(pyskin.joints):
-            bone = gltf.vnodes[node_idx]
-            ob.vertex_groups.new(name=bone.blender_bone_name)
-
-        vgs = list(ob.vertex_groups)
-
-        for i in range(num_joint_sets):
-            js = vert_joints[i].tolist()  # tolist() is faster
-            ws = vert_weights[i].tolist()
-            for vi in range(len(vert_locs)):
-                w0, w1, w2, w3 = ws[vi]
-                j0, j1, j2, j3 = js[vi]
-                if w0 != 0: vgs[j0].add((vi,), w0, 'REPLACE')
-                if w1 != 0: vgs[j1].add((vi,), w1, 'REPLACE')
-                if w2 != 0: vgs[j2].add((vi,), w2, 'REPLACE')
-                if w3 != 0: vgs[j3].add((vi,), w3, 'REPLACE')
+    with profile_stage('skinning'):
+        if num_joint_sets and mesh_options.skinning:
+            pyskin = gltf.data.skins[skin_idx]
+            for i, node_idx in enumerate(pyskin.joints):
+                bone = gltf.vnodes[node_idx]
+                ob.vertex_groups.new(name=bone.blender_bone_name)
+
+            vgs = list(ob.vertex_groups)
+
+            for i in range(num_joint_sets):
+                js = vert_joints[i].tolist()  # tolist() is faster
+                ws = vert_weights[i].tolist()
+                for vi in range(len(vert_locs)):
+                    w0, w1, w2, w3 = ws[vi]
+                    j0, j1, j2, j3 = js[vi]
+                    if w0 != 0: vgs[j0].add((vi,), w0, 'REPLACE')
+                    if w1 != 0: vgs[j1].add((vi,), w1, 'REPLACE')
+                    if w2 != 0: vgs[j2].add((vi,), w2, 'REPLACE')
+                    if w3 != 0: vgs[j3].add((vi,), w3, 'REPLACE')
 
     # Shapekeys
     if num_shapekeys:
@@ -602,6 +604,7 @@ def uvs_gltf_to_blender(uvs):
     uvs[:, 1] += 1
 
 
+@profiled('skinning')
 def skin_into_bind_pose(gltf, skin_idx, vert_joints, vert_weights, locs, vert_normals):
     # Skin each position/normal using the bind pose.
     # Skinning equation: vert' = sum_(j,w) w * joint_mat[j] * vert
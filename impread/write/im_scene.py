@@ -35,6 +35,7 @@ from .im_animation import BlenderAnimation
 from .im_vnode import VNode, compute_vnodes
 from .dasar.g2b_extras import set_extras
 from .dasar.g2_binary import import_user_extensions
+from .dasar.g2_debug import profile_stage, profiled
 
 
 class BlenderScene():
@@ -57,7 +58,8 @@ class BlenderScene():
             pyscene = gltf.data.scenes[gltf.data.scene]
             set_extras(scene, pyscene.extras)
 
-        compute_vnodes(gltf)
+        with profile_stage('vnode compute'):
+            compute_vnodes(gltf)
 
         gltf.display_current_node = 0  # for debugging
         BlenderNode.create_vnode(gltf, 'root')
@@ -82,6 +84,7 @@ class BlenderScene():
         BlenderScene.set_active_object(gltf)
 
     @staticmethod
+    @profiled('animation')
     def create_animations(gltf):
         """Create animations."""
 
@@ -41,6 +41,7 @@ from bpy.types import Operator
 from .impread.readg2 import glTFImporter, ImportError
 from .impread.imblen import BlenderGlTF
 from .impread.readvrm import VRMread
+from .impread.write.dasar.g2_debug import profile_file
 from bpy.props import (StringProperty,
                        BoolProperty,
                        EnumProperty,
@@ -116,6 +117,7 @@ class ImportVRM(Operator, ConvertGLTF2_Base, ImportHelper):
     
     gunakan_vrmmeta: BoolProperty(name='Use the VRM data from the model to the VRM tool', default=True)
     gunakan_model: BoolProperty(name='Import model from VRM (Disable it if you only want to import VRM Meta Data)', default=True)
+    profile: BoolProperty(name='Profile', description='Write time and memory of every import stage to a .import.profile.json file next to the VRM', default=False)
     
     def draw(self, context):
         layout = self.layout
@@ -135,6 +137,7 @@ class ImportVRM(Operator, ConvertGLTF2_Base, ImportHelper):
         layout.label(text="Import model", icon= 'USER')
         layout.prop(self, "gunakan_model", text= "Import model")
         layout.label(text="Disable it if you only want to import VRM meta data")
+        layout.prop(self, "profile")
 
     def invoke(self, context, event):
         preferences = bpy.context.preferences
@@ -184,6 +187,13 @@ class ImportVRM(Operator, ConvertGLTF2_Base, ImportHelper):
             return self.unit_import(self.filepath, import_settings)
 
     def unit_import(self, filename, import_settings):
+        if not self.profile:
+            return self.import_file(filename, import_settings)
+
+        with profile_file(os.path.splitext(filename)[0] + '.import.profile.json'):
+            return self.import_file(filename, import_settings)
+
+    def import_file(self, filename, import_settings):
 
         try:
             if self.gunakan_vrmmeta == True:
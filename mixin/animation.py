@@ -20,19 +20,64 @@ import bpy
 import collections
 import copy
 import decimal
+import io
 import math
+import numpy as np
+import re
 
 try:
     from collections.abc import Callable
 except ImportError:
     from collections import Callable
 
-from .dasar.matrices import get_bone_matrix, quat_to_list
+from .dasar import bake
+from .dasar.arrays import foreach_get, matrix_to_array
+from .dasar.cache import hash_data, make_key
+from .dasar.matrices import quat_to_list
+from ..impread.write.dasar.g2_debug import profiled
 
 #from . import spec
 from .dasar import spec
 
+# pose bone transform F-curves, like 'pose.bones["Hips"].location'
+POSE_BONE_PATH = re.compile(
+    r'^pose\.bones\["((?:[^"\\]|\\.)*)"\]\.'
+    r'(location|rotation_quaternion|rotation_euler|rotation_axis_angle|scale)$')
+
+BAKE_CACHE_SIZE = 256 * 1024 * 1024
+BAKE_CACHE_VERSION = 2  # change when baking gives different results
+
+
+def unescape(name):
+    return re.sub(r'\\(.)', r'\1', name)
+
+
+def is_fcurve_muted(fcurve):
+    return fcurve.mute or bool(fcurve.group and fcurve.group.mute)
+
+
+def get_action_fcurves(action):
+    """
+    F-curves of the action, also for layered actions of Blender 4.4+.
+    """
+    if getattr(action, 'layers', None):
+        for layer in action.layers:
+            for strip in layer.strips:
+                for channelbag in strip.channelbags:
+                    yield from channelbag.fcurves
+    else:
+        yield from action.fcurves
+
+
 class AnimationMixin(object):
+    def make_animation(self, parent_node, obj=None):
+        self._bake_stats = collections.Counter()
+        super().make_animation(parent_node, obj)
+        if self._bake_cache:
+            print('bake cache: {} hits, {} misses, {} not cacheable'.format(
+                self._bake_stats['hit'], self._bake_stats['miss'],
+                self._bake_stats['skip']))
+
     def _make_sampler(self, path, input_id, bone):
         # transforms
         channel = self._buffer.add_channel({
@@ -53,12 +98,34 @@ class AnimationMixin(object):
         }
         return gltf_sampler
 
+    def _reduce_keys(self, times, values, gltf_joint, path):
+        """
+        Returns ids of the keys to export, None if the channel is constant
+        and the same as the joint node, so it's not needed at all.
+        Keys are removed when interpolation of the other keys gives
+        the same values, within the tolerance.
+        """
+        if not len(times):
+            return None
+        if not self._key_tolerance:
+            return np.arange(len(times))
+
+        rotation = path == 'rotation'
+        errors = bake.key_error(values, values[[0] * len(values)], rotation)
+        if errors.max() <= self._key_tolerance:  # constant
+            node_value = np.array([gltf_joint[path]], dtype=np.float64)
+            if bake.key_error(values[:1], node_value, rotation)[0] <= self._key_tolerance:
+                return None
+            return np.array([0])
+
+        return bake.reduce_keys(
+            times.astype(np.float64), values, self._key_tolerance, rotation)
+
     def make_action(self, node, armature, action):
         gltf_armature = None
-        for i, gltf_node in enumerate(self._root['nodes']):
-            if gltf_node['name'] == armature.name:
-                gltf_armature = gltf_node
-                break
+        gltf_armature_id = self._root.find('nodes', armature.name)
+        if gltf_armature_id is not None:
+            gltf_armature = self._root['nodes'][gltf_armature_id]
         if not gltf_armature:
             gltf_armature = self.make_armature(node, armature)
 
@@ -80,9 +147,39 @@ class AnimationMixin(object):
             'samplers': [],
         }
 
+        # set animation data
+        frame_start = bpy.context.scene.frame_start
+        frame_end = bpy.context.scene.frame_end
+        if action and armature.animation_data:
+            armature.animation_data.action = action
+            frame_start, frame_end = action.frame_range
+
+        samples = self._get_bake_samples(frame_start, frame_end)
+        bone_names = [
+            self._root['nodes'][gltf_joint_id]['name']
+            for gltf_joint_id in gltf_skin['joints']]
+
+        # bake bones from F-curves, bones which need scene evaluation by frame_set
+        scene_bones = bone_names
+        baked = {}
+        if self._bake_engine == 'fcurve' and action and armature.animation_data:
+            evaluated = self.get_evaluated_bones(armature)
+            if evaluated is not None:
+                scene_bones = [name for name in bone_names if name in evaluated]
+                baked.update(self.bake_fcurves_cached(
+                    armature, action,
+                    [name for name in bone_names if name not in evaluated],
+                    samples))
+        elif self._bake_cache:
+            self._bake_stats['skip'] += 1
+        if scene_bones:
+            baked.update(self.bake_scene(armature, scene_bones, samples))
+
         # setup bones
-        gltf_channels = {}
-        gltf_samplers = []
+        times = np.array([t for frame, speed_scale, t in samples], dtype=np.float32)
+        gltf_inputs = {}  # kept keys -> time input, shared by the samplers
+        keys_before = 0
+        keys_after = 0
         for gltf_joint_id in gltf_skin['joints']:
             gltf_joint = self._root['nodes'][gltf_joint_id]
             bone = armature.data.bones[gltf_joint['name']]
@@ -91,89 +188,307 @@ class AnimationMixin(object):
             if gltf_joint_id is not None:
                 gltf_target['node'] = gltf_joint_id
 
-            # time or animation frame
-            channel = self._buffer.add_channel({
-                'componentType': spec.TYPE_FLOAT,
-                'type': 'SCALAR',
-                'extras': {
-                    'reference': 'input',
-                },
-            })
-            input_id = channel['bufferView']
-
-            for path in ('rotation', 'scale', 'translation'):
-                gltf_samplers.append(self._make_sampler(path, input_id, bone))
+            for path, values in zip(('rotation', 'scale', 'translation'), baked[bone.name]):
+                values = np.asarray(values, dtype=np.float64).reshape(len(times), -1)
+                keys = self._reduce_keys(times, values, gltf_joint, path)
+                keys_before += len(times)
+                if keys is None:  # the same as the joint node, no channel
+                    continue
+                keys_after += len(keys)
+
+                # time or animation frame
+                if keys.tobytes() not in gltf_inputs:
+                    channel = self._buffer.add_channel({
+                        'componentType': spec.TYPE_FLOAT,
+                        'type': 'SCALAR',
+                        'min': [float(times[keys[0]])],
+                        'max': [float(times[keys[-1]])],
+                        'extras': {
+                            'reference': 'input',
+                        },
+                    })
+                    self._buffer.write_array(channel['bufferView'], times[keys])
+                    gltf_inputs[keys.tobytes()] = channel['bufferView']
+
+                gltf_sampler = self._make_sampler(path, gltf_inputs[keys.tobytes()], bone)
+                self._buffer.write_array(gltf_sampler['output'], values[keys])
+                gltf_animation['samplers'].append(gltf_sampler)
 
                 gltf_channel = {
-                    'sampler': len(gltf_samplers) - 1,
+                    'sampler': len(gltf_animation['samplers']) - 1,
                     'target': copy.copy(gltf_target),
                     'extras': {
                         'joint': bone.name,
                     }
                 }
                 gltf_channel['target']['path'] = path
-                gltf_channels['{}/{}'.format(bone.name, path)] = gltf_channel
+                gltf_animation['channels'].append(gltf_channel)
 
-        gltf_animation['channels'] = list(gltf_channels.values())
-        gltf_animation['samplers'] = gltf_samplers
+        print('{}: {} -> {} keys, {} time inputs'.format(
+            gltf_animation['name'], keys_before, keys_after, len(gltf_inputs)))
 
-        # set animation data
-        frame_start = bpy.context.scene.frame_start
-        frame_end = bpy.context.scene.frame_end
-        if action and armature.animation_data:
-            armature.animation_data.action = action
-            frame_start, frame_end = action.frame_range
+        # glTF animations need at least one channel
+        if not gltf_animation['channels']:
+            print('{}: no bone moves, the animation is not exported'.format(
+                gltf_animation['name']))
+            return
+
+        # animation -->
 
+        self._root['animations'].append(gltf_animation)
+        self.stream_buffer(gltf_animation['name'])
+
+    def _get_bake_samples(self, frame_start, frame_end):
+        """
+        Returns (frame, speed scale, time) of every baked frame.
+        """
+        samples = []
         frame = float(frame_start)
-        frame_int = None
         t = decimal.Decimal(0)
         fps = bpy.context.scene.render.fps / bpy.context.scene.render.fps_base
         dt = decimal.Decimal(1 / fps)
         t += dt
         while frame <= frame_end:
+            if isinstance(self._speed_scale, Callable):
+                speed_scale = self._speed_scale(math.floor(frame))
+            else:
+                speed_scale = self._speed_scale
+
+            samples.append((frame, speed_scale, float(t)))
+
+            # advance to the next frame
+            frame += speed_scale
+            t += dt
+
+        return samples
+
+    def get_evaluated_bones(self, armature):
+        """
+        Returns names of bones which can't be baked from the F-curves,
+        None if no bone can.
+        """
+        animation_data = armature.animation_data
+        if any(not track.mute for track in animation_data.nla_tracks):
+            return None
+
+        # the action is mixed with the current pose
+        if (getattr(animation_data, 'action_influence', 1) != 1 or
+                getattr(animation_data, 'action_blend_type', 'REPLACE') != 'REPLACE'):
+            return None
+
+        results = set()
+
+        # muted F-curves keep whatever the scene left in the pose
+        if animation_data.action:
+            for fcurve in get_action_fcurves(animation_data.action):
+                match = POSE_BONE_PATH.match(fcurve.data_path)
+                if match and is_fcurve_muted(fcurve):
+                    results.add(unescape(match.group(1)))
+
+        # driven pose bones
+        for fcurve in animation_data.drivers:
+            match = POSE_BONE_PATH.match(fcurve.data_path)
+            if match:
+                results.add(unescape(match.group(1)))
+
+        for bone in armature.pose.bones:
+            # transform which doesn't depend only on the bone channels
+            if (bone.constraints or bone.bone.use_relative_parent or
+                    not bone.bone.use_inherit_rotation or
+                    not bone.bone.use_local_location or
+                    getattr(bone.bone, 'inherit_scale', 'FULL') != 'FULL'):
+                results.add(bone.name)
+
+            # IK moves the parent bones of the chain too
+            for constraint in bone.constraints:
+                if constraint.type not in ('IK', 'SPLINE_IK'):
+                    continue
+                parent = bone.parent
+                chain_count = constraint.chain_count
+                while parent and chain_count != 1:
+                    results.add(parent.name)
+                    parent = parent.parent
+                    chain_count -= 1
+
+        return results
+
+    @profiled('animation bake')
+    def bake_scene(self, armature, bone_names, samples):
+        """
+        Bake bones by switching scene frames.
+        Returns {bone name: (rotations, scales, translations)}.
+        """
+        results = {name: ([], [], []) for name in bone_names}
+
+        frame_int = None
+        for frame, speed_scale, t in samples:
             # switch frame
             if frame_int != math.floor(frame):
                 frame_int = math.floor(frame)
                 bpy.context.scene.frame_current = frame_int
                 bpy.context.scene.frame_set(frame_int)
 
-            if isinstance(self._speed_scale, Callable):
-                speed_scale = self._speed_scale(frame_int)
-            else:
-                speed_scale = self._speed_scale
-
             # switch subframe
             if speed_scale != 1:
                 bpy.context.scene.frame_subframe = frame - frame_int
 
-            # write bone matrices
-            for gltf_joint_id in gltf_skin['joints']:
-                gltf_joint = self._root['nodes'][gltf_joint_id]
-                bone = armature.pose.bones[gltf_joint['name']]
-                bone_matrix = self._transform(get_bone_matrix(bone, armature))
-
-                rotation = quat_to_list(bone_matrix.to_quaternion())
-                scale = list(bone_matrix.to_scale())
-                translation = list(bone_matrix.to_translation())
-
-                gltf_channel = gltf_channels['{}/{}'.format(bone.name, 'rotation')]
-                gltf_sampler = gltf_samplers[gltf_channel['sampler']]
-                self._buffer.write(gltf_sampler['output'], *rotation)
-
-                gltf_channel = gltf_channels['{}/{}'.format(bone.name, 'scale')]
-                gltf_sampler = gltf_samplers[gltf_channel['sampler']]
-                self._buffer.write(gltf_sampler['output'], *scale)
-
-                gltf_channel = gltf_channels['{}/{}'.format(bone.name, 'translation')]
-                gltf_sampler = gltf_samplers[gltf_channel['sampler']]
-                self._buffer.write(gltf_sampler['output'], *translation)
-
-                self._buffer.write(gltf_sampler['input'], float(t))
-
-            # advance to the next frame
-            frame += speed_scale
-            t += dt
-
-        # animation -->
+            for bone_name in bone_names:
+                bone = armature.pose.bones[bone_name]
+                bone_matrix = self._get_pose_matrix(bone, armature)
+                if bone.parent:
+                    bone_matrix = self._get_pose_matrix(bone.parent, armature).inverted() @ bone_matrix
+                bone_matrix = self._transform(bone_matrix)
+
+                rotations, scales, translations = results[bone_name]
+                rotations.append(quat_to_list(bone_matrix.to_quaternion()))
+                scales.append(list(bone_matrix.to_scale()))
+                translations.append(list(bone_matrix.to_translation()))
+
+        return results
+
+    def get_bake_key(self, armature, action, bone_names, samples):
+        """
+        Returns cache key of everything bake_fcurves reads: the F-curves
+        of the bones, the current pose and rest pose of the bones,
+        the baked frames and the export settings.
+        None if the bones can't be cached.
+        """
+        bone_set = set(bone_names)
+        fcurves = []
+        for fcurve in get_action_fcurves(action):
+            match = POSE_BONE_PATH.match(fcurve.data_path)
+            if not match or unescape(match.group(1)) not in bone_set:
+                continue
+            if len(fcurve.modifiers):  # modifier settings are not hashed
+                return None
+
+            points = fcurve.keyframe_points
+            fcurves.append((
+                fcurve.data_path, fcurve.array_index, fcurve.extrapolation,
+                is_fcurve_muted(fcurve),
+                hash_data(np.concatenate((
+                    foreach_get(points, 'co', np.float32, 2),
+                    foreach_get(points, 'handle_left', np.float32, 2),
+                    foreach_get(points, 'handle_right', np.float32, 2),
+                ), axis=1).tobytes()),
+                [(point.interpolation, point.easing, point.back,
+                  point.amplitude, point.period) for point in points],
+            ))
+
+        bones = []
+        for bone_name in bone_names:
+            bone = armature.pose.bones[bone_name]
+            rest = [matrix_to_array(self._get_rest_matrix(bone.bone, armature))]
+            if bone.parent:
+                rest.append(matrix_to_array(self._get_rest_matrix(bone.parent.bone, armature)))
+            pose = np.concatenate([
+                tuple(getattr(bone, prop)) for prop in (
+                    'location', 'rotation_quaternion', 'rotation_euler',
+                    'rotation_axis_angle', 'scale')])
+            bones.append((
+                bone_name, bone.rotation_mode,
+                hash_data(np.concatenate([m.ravel() for m in rest] + [pose]).tobytes())))
+
+        return make_key(
+            'bake', BAKE_CACHE_VERSION, sorted(fcurves), bones,
+            hash_data(np.array(samples, dtype=np.float64).tobytes()),
+            self._z_up, self._pose_freeze,
+            matrix_to_array(self._matrix).tolist(),
+            matrix_to_array(self._matrix_inv).tolist())
+
+    @profiled('animation bake')
+    def bake_fcurves_cached(self, armature, action, bone_names, samples):
+        """
+        bake_fcurves through the bake cache, the baked arrays are reused
+        while the F-curves, the rest pose and the settings are unchanged.
+        """
+        key = None
+        if self._bake_cache and bone_names:
+            key = self.get_bake_key(armature, action, bone_names, samples)
+            if key is None:
+                self._bake_stats['skip'] += 1
+
+        if key:
+            cached = self._bake_cache.get(key)
+            if cached and cached[1].get('bones') == bone_names:
+                self._bake_stats['hit'] += 1
+                # (bones, frames, 4 + 3 + 3) rotations, scales, translations
+                stacked = np.load(cached[0])
+                return {
+                    bone_name: (values[:, :4], values[:, 4:7], values[:, 7:])
+                    for bone_name, values in zip(bone_names, stacked)}
+
+        results = self.bake_fcurves(armature, action, bone_names, samples)
+
+        if key:
+            self._bake_stats['miss'] += 1
+            data = io.BytesIO()
+            np.save(data, np.stack([
+                np.concatenate(results[bone_name], axis=1)
+                for bone_name in bone_names]))
+            self._bake_cache.put(key, data.getvalue(), {
+                'action': action.name,
+                'bones': bone_names,
+            })
 
-        self._root['animations'].append(gltf_animation)
+        return results
+
+    def bake_fcurves(self, armature, action, bone_names, samples):
+        """
+        Bake bones by evaluating the action F-curves,
+        the bone matrices are composed for all frames at once.
+        Returns {bone name: (rotations, scales, translations)}.
+        """
+        frames = np.array([
+            frame if speed_scale != 1 else math.floor(frame)
+            for frame, speed_scale, t in samples])
+
+        fcurves = {}
+        for fcurve in get_action_fcurves(action):
+            match = POSE_BONE_PATH.match(fcurve.data_path)
+            if match and not is_fcurve_muted(fcurve):
+                fcurves[unescape(match.group(1)), match.group(2), fcurve.array_index] = fcurve
+
+        def evaluate(bone, prop):
+            # channels without F-curves keep the current pose values
+            values = np.tile(np.array(tuple(getattr(bone, prop)), dtype=np.float64), (len(frames), 1))
+            for i in range(values.shape[1]):
+                fcurve = fcurves.get((bone.name, prop, i))
+                if fcurve is not None:
+                    values[:, i] = [fcurve.evaluate(frame) for frame in frames]
+            return values
+
+        axis = np.identity(4)
+        axis[:3, :3] = matrix_to_array(self._matrix)
+        axis_inv = np.identity(4)
+        axis_inv[:3, :3] = matrix_to_array(self._matrix_inv)
+
+        results = {}
+        for bone_name in bone_names:
+            bone = armature.pose.bones[bone_name]
+
+            if bone.rotation_mode == 'QUATERNION':
+                rotations = bake.quaternion_to_matrix(evaluate(bone, 'rotation_quaternion'))
+            elif bone.rotation_mode == 'AXIS_ANGLE':
+                rotations = bake.axis_angle_to_matrix(evaluate(bone, 'rotation_axis_angle'))
+            else:
+                rotations = bake.euler_to_matrix(
+                    evaluate(bone, 'rotation_euler'), bone.rotation_mode)
+
+            # pose basis in the parent bone space
+            matrices = bake.compose(
+                evaluate(bone, 'location'), rotations, evaluate(bone, 'scale'))
+            rest = matrix_to_array(self._get_rest_matrix(bone.bone, armature))
+            if bone.parent:
+                rest = np.linalg.inv(matrix_to_array(
+                    self._get_rest_matrix(bone.parent.bone, armature))) @ rest
+            matrices = rest @ matrices
+            if not self._z_up:
+                matrices = axis @ matrices @ axis_inv
+
+            translations, rotations, scales = bake.decompose(matrices)
+            results[bone_name] = (
+                np.roll(rotations, -1, axis=1),  # w, x, y, z -> x, y, z, w
+                scales, translations)
+
+        return results
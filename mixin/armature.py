@@ -209,11 +209,8 @@ class ArmatureMixin(object):
                 self._root['extensions']['VRM']['secondaryAnimation']['colliderGroups'].append(sewa)
                     
         for bone_name, bone in armature.data.bones.items():
-            gltf_node_id = None
-            for gltf_node_id, gltf_node in enumerate(self._root['nodes']):
-                if gltf_node['name'] == bone_name:
-                    break
-            else:
+            gltf_node_id = self._root.find('nodes', bone_name)
+            if gltf_node_id is None:
                 continue
 
             vrm_bone = self._make_vrm_bone(gltf_node_id, bone)
@@ -0,0 +1,42 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+import numpy as np
+
+
+def foreach_get(collection, attr, dtype, size=1):
+    """
+    Read an attribute of every item in a Blender collection into a numpy array.
+    """
+    array = np.empty(len(collection) * size, dtype=dtype)
+    collection.foreach_get(attr, array)
+    if size > 1:
+        array = array.reshape(-1, size)
+    return array
+
+
+def matrix_to_array(matrix):
+    return np.array([tuple(row) for row in matrix], dtype=np.float64)
+
+
+def transform_points(matrix, points):
+    """
+    Multiply (N, 3) points by a 4x4 matrix (or directions by a 3x3 matrix).
+    """
+    matrix = matrix_to_array(matrix)
+    result = points @ matrix[:3, :3].T
+    if len(matrix) == 4:
+        result += matrix[:3, 3]
+    return result
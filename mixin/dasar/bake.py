@@ -0,0 +1,194 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+"""
+Pose math on (frames, ...) arrays, the same as Blender does for pose bones.
+Quaternions are (w, x, y, z) as in Blender, unless said otherwise.
+"""
+
+import numpy as np
+
+
+def quaternion_to_matrix(quats):
+    """
+    (N, 4) quaternions to (N, 3, 3) rotation matrices, quaternions are normalized.
+    """
+    quats = quats / np.linalg.norm(quats, axis=1, keepdims=True)
+    w, x, y, z = quats.T
+    return np.stack((
+        np.stack((1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y)), axis=1),
+        np.stack((2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x)), axis=1),
+        np.stack((2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)), axis=1),
+    ), axis=1)
+
+
+def axis_angle_to_matrix(axis_angles):
+    """
+    (N, 4) rotations as (angle, x, y, z) to (N, 3, 3) rotation matrices.
+    """
+    angles = axis_angles[:, 0] / 2
+    axes = axis_angles[:, 1:]
+    lengths = np.linalg.norm(axes, axis=1, keepdims=True)
+    axes = np.where(lengths > 0, axes / np.where(lengths > 0, lengths, 1), (0, 1, 0))
+    return quaternion_to_matrix(np.column_stack((
+        np.cos(angles), axes * np.sin(angles)[:, None])))
+
+
+def _axis_matrix(axis, angles):
+    c = np.cos(angles)
+    s = np.sin(angles)
+    zeros = np.zeros_like(angles)
+    ones = np.ones_like(angles)
+    rows = {
+        'X': ((ones, zeros, zeros), (zeros, c, -s), (zeros, s, c)),
+        'Y': ((c, zeros, s), (zeros, ones, zeros), (-s, zeros, c)),
+        'Z': ((c, -s, zeros), (s, c, zeros), (zeros, zeros, ones)),
+    }[axis]
+    return np.stack([np.stack(row, axis=1) for row in rows], axis=1)
+
+
+def euler_to_matrix(eulers, order='XYZ'):
+    """
+    (N, 3) euler angles to (N, 3, 3) rotation matrices.
+    The first axis of order is applied first.
+    """
+    matrix = None
+    for axis in order:
+        axis_matrix = _axis_matrix(axis, eulers[:, 'XYZ'.index(axis)])
+        matrix = axis_matrix if matrix is None else axis_matrix @ matrix
+    return matrix
+
+
+def compose(translations, rotations, scales):
+    """
+    Make (N, 4, 4) matrices from translations, (N, 3, 3) rotations and scales.
+    """
+    matrices = np.zeros((len(translations), 4, 4))
+    matrices[:, :3, :3] = rotations * scales[:, None, :]
+    matrices[:, :3, 3] = translations
+    matrices[:, 3, 3] = 1
+    return matrices
+
+
+def matrix_to_quaternion(matrices):
+    """
+    (N, 3, 3) rotation matrices to (N, 4) quaternions with non-negative w.
+    """
+    m = matrices
+    trace = m[:, 0, 0] + m[:, 1, 1] + m[:, 2, 2]
+    cases = np.argmax(np.column_stack((
+        trace, m[:, 0, 0], m[:, 1, 1], m[:, 2, 2])), axis=1)
+
+    quats = np.zeros((len(m), 4))
+    for case, (i, j, k) in enumerate(((None, None, None), (0, 1, 2), (1, 2, 0), (2, 0, 1))):
+        rows = cases == case
+        r = m[rows]
+        if not len(r):
+            continue
+        if case == 0:
+            s = np.sqrt(trace[rows] + 1) * 2
+            quats[rows, 0] = s / 4
+            quats[rows, 1] = (r[:, 2, 1] - r[:, 1, 2]) / s
+            quats[rows, 2] = (r[:, 0, 2] - r[:, 2, 0]) / s
+            quats[rows, 3] = (r[:, 1, 0] - r[:, 0, 1]) / s
+        else:
+            s = np.sqrt(1 + r[:, i, i] - r[:, j, j] - r[:, k, k]) * 2
+            quats[rows, 0] = (r[:, k, j] - r[:, j, k]) / s
+            quats[rows, 1 + i] = s / 4
+            quats[rows, 1 + j] = (r[:, j, i] + r[:, i, j]) / s
+            quats[rows, 1 + k] = (r[:, k, i] + r[:, i, k]) / s
+
+    quats[quats[:, 0] < 0] *= -1
+    return quats
+
+
+def decompose(matrices):
+    """
+    Split (N, 4, 4) matrices into translations, (w, x, y, z) rotations and scales,
+    like Matrix.to_translation, to_quaternion and to_scale.
+    """
+    basis = matrices[:, :3, :3]
+    scales = np.linalg.norm(basis, axis=1)
+    normalized = basis / np.where(scales > 0, scales, 1)[:, None, :]
+    # negative scale, take the rotation of the mirrored matrix
+    normalized[np.linalg.det(normalized) < 0] *= -1
+    return matrices[:, :3, 3], matrix_to_quaternion(normalized), scales
+
+
+def slerp(quats0, quats1, factors):
+    """
+    Spherical interpolation of (N, 4) quaternions by (N) factors, shortest path.
+    Any component order, the same for both.
+    """
+    dots = np.sum(quats0 * quats1, axis=1)
+    quats1 = np.where(dots[:, None] < 0, -quats1, quats1)
+    dots = np.clip(np.abs(dots), 0, 1)
+
+    angles = np.arccos(dots)
+    sines = np.sin(angles)
+    near = sines < 1e-6
+    sines = np.where(near, 1, sines)
+    weights0 = np.where(near, 1 - factors, np.sin((1 - factors) * angles) / sines)
+    weights1 = np.where(near, factors, np.sin(factors * angles) / sines)
+    result = quats0 * weights0[:, None] + quats1 * weights1[:, None]
+    return result / np.linalg.norm(result, axis=1, keepdims=True)
+
+
+def key_error(values, expected, rotation=False):
+    """
+    Max component difference of every key, quaternion signs are ignored.
+    """
+    if rotation:
+        dots = np.sum(values * expected, axis=1)
+        expected = np.where(dots[:, None] < 0, -expected, expected)
+    return np.abs(values - expected).max(axis=1)
+
+
+def reduce_keys(times, values, tolerance, rotation=False):
+    """
+    Find keys of (frames, components) values, which are needed to
+    reproduce all the values with linear (slerp for rotations) interpolation.
+    Returns sorted ids of the kept keys.
+    """
+    keep = np.zeros(len(times), dtype=bool)
+    keep[[0, -1]] = True
+
+    # Douglas-Peucker, split segments at the worst key until all fit
+    segments = [(0, len(times) - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+
+        factors = (times[first + 1:last] - times[first]) / (times[last] - times[first])
+        count = last - first - 1
+        if rotation:
+            interpolated = slerp(
+                np.repeat(values[first:first + 1], count, axis=0),
+                np.repeat(values[last:last + 1], count, axis=0),
+                factors)
+        else:
+            interpolated = (
+                values[first] + (values[last] - values[first]) * factors[:, None])
+
+        errors = key_error(values[first + 1:last], interpolated, rotation)
+        worst = int(np.argmax(errors))
+        if errors[worst] > tolerance:
+            middle = first + 1 + worst
+            keep[middle] = True
+            segments.append((first, middle))
+            segments.append((middle, last))
+
+    return np.flatnonzero(keep)
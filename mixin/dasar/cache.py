@@ -0,0 +1,171 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+import hashlib
+import json
+import os
+
+# entries kept at most, small entries like file hashes count too
+MAX_ENTRIES = 10000
+
+# eviction makes room down to this fraction of the limits,
+# so it doesn't run again on the next put
+EVICT_TARGET = 0.9
+
+
+def make_key(*parts):
+    """
+    Make cache key from content hashes and processing parameters.
+    """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def hash_data(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(filepath, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DiskCache(object):
+    """
+    Persistent cache of files in a directory, limited by size.
+    Every entry is a data file "<key>.bin" with a metadata file "<key>.json",
+    both count to the size. The least recently used entries are removed
+    first, entries used by this cache object are kept, because their
+    files may still be read. The directory is listed once, on the first
+    put, later puts update the index.
+    """
+    def __init__(self, path, max_size, max_entries=MAX_ENTRIES):
+        self._path = path
+        self._max_size = max_size
+        self._max_entries = max_entries
+        self._in_use = set()
+        self._index = None  # data file -> [last use, size of both files]
+        self._size = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _load_index(self):
+        self._index = {}
+        self._size = 0
+        sizes = {}
+        with os.scandir(self._path) as it:
+            for entry in it:
+                base, ext = os.path.splitext(entry.path)
+                if ext not in ('.bin', '.json'):
+                    continue
+                stat = entry.stat()
+                sizes.setdefault(base, {})[ext] = stat
+        for base, stats in sizes.items():
+            if '.bin' not in stats:
+                continue
+            size = sum(stat.st_size for stat in stats.values())
+            self._index[base + '.bin'] = [stats['.bin'].st_mtime, size]
+            self._size += size
+
+    def _entry(self, key):
+        return (
+            os.path.join(self._path, key + '.bin'),
+            os.path.join(self._path, key + '.json'))
+
+    def get(self, key):
+        """
+        Returns (filepath, metadata) of the entry, None if not cached.
+        """
+        data_fp, meta_fp = self._entry(key)
+        try:
+            with open(meta_fp, 'r') as f:
+                metadata = json.load(f)
+            os.utime(data_fp)  # mark as recently used
+        except (OSError, ValueError):
+            return None
+        self._in_use.add(data_fp)
+        if self._index is not None and data_fp in self._index:
+            self._index[data_fp][0] = os.path.getmtime(data_fp)
+        return data_fp, metadata
+
+    def put(self, key, data, metadata=None):
+        """
+        Store data with metadata, returns (filepath, metadata) of the entry.
+        """
+        data_fp, meta_fp = self._entry(key)
+        metadata = metadata or {}
+
+        if self._index is None:
+            self._load_index()
+
+        # write to temporary files first, so readers never see half an entry
+        size = 0
+        for filepath, content in ((data_fp, data), (meta_fp, json.dumps(metadata).encode())):
+            tmp_fp = '{}.{}.tmp'.format(filepath, os.getpid())
+            with open(tmp_fp, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_fp, filepath)
+            size += len(content)
+
+        self._in_use.add(data_fp)
+        if data_fp in self._index:
+            self._size -= self._index[data_fp][1]
+        self._index[data_fp] = [os.path.getmtime(data_fp), size]
+        self._size += size
+
+        if self._size > self._max_size or len(self._index) > self._max_entries:
+            self.evict()
+        return data_fp, metadata
+
+    def get_hash(self, filepath):
+        """
+        Returns content hash of the file.
+        Unchanged files (same size and modification time) are not read again.
+        """
+        stat = os.stat(filepath)
+        key = make_key('stat', os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        cached = self.get(key)
+        if cached:
+            return cached[1]['hash']
+
+        hash_ = hash_file(filepath)
+        self.put(key, b'', {'hash': hash_})
+        return hash_
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits
+        the limits, with some room for the next entries.
+        """
+        if self._index is None:
+            self._load_index()
+
+        max_size = self._max_size * EVICT_TARGET
+        max_entries = int(self._max_entries * EVICT_TARGET)
+        entries = sorted(
+            (last_use, data_fp) for data_fp, (last_use, _) in self._index.items())
+        for _, data_fp in entries:
+            if self._size <= max_size and len(self._index) <= max_entries:
+                break
+            if data_fp in self._in_use:
+                continue
+            for filepath in (data_fp, data_fp[:-len('.bin')] + '.json'):
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+            self._size -= self._index.pop(data_fp)[1]
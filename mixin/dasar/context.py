@@ -27,3 +27,22 @@ class Mode(object):
 
     def __exit__(self, *args, **kw):
         bpy.ops.object.mode_set(mode='OBJECT')
+
+
+class NoArmatureDeform(object):
+    """
+    Hide armature modifiers, so evaluated meshes are in the rest pose,
+    like apply_modifiers which doesn't apply them. Restored on exit.
+    """
+    def __enter__(self):
+        self._modifiers = [
+            mod for obj in bpy.data.objects for mod in obj.modifiers
+            if mod.type == 'ARMATURE' and mod.show_viewport]
+        for mod in self._modifiers:
+            mod.show_viewport = False
+        bpy.context.view_layer.update()
+
+    def __exit__(self, *args, **kw):
+        for mod in self._modifiers:
+            mod.show_viewport = True
+        bpy.context.view_layer.update()
@@ -0,0 +1,48 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+# root lists which can be searched by name
+INDEXED = ('nodes', 'meshes', 'materials', 'images', 'textures', 'skins')
+
+
+class GLTFDocument(dict):
+    """
+    glTF root dict with name -> index maps of the root lists,
+    serializes to the same JSON as a plain dict.
+    Items appended to the lists directly are indexed on the next search.
+    The first item with a name wins, like a linear search.
+    """
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._names = {kind: {} for kind in INDEXED}
+        self._indexed = {kind: 0 for kind in INDEXED}
+
+    def add(self, kind, item):
+        """
+        Append item to the root list, returns its index.
+        """
+        self[kind].append(item)
+        return len(self[kind]) - 1
+
+    def find(self, kind, name):
+        """
+        Returns index of the first item with the name, None if not found.
+        """
+        items = self.get(kind, [])
+        names = self._names[kind]
+        for i in range(self._indexed[kind], len(items)):
+            names.setdefault(items[i].get('name'), i)
+        self._indexed[kind] = len(items)
+        return names.get(name)
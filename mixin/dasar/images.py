@@ -0,0 +1,76 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+import io
+import time
+
+# Pillow is not bundled with Blender, images are embedded as is without it
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PNG_LEVELS = {
+    'KEEP': None,
+    'FAST': 1,
+    'DEFAULT': 6,
+    'BEST': 9,
+}
+
+
+def can_process_images():
+    return Image is not None
+
+
+def is_opaque(image):
+    if image.mode in ('RGB', 'L'):
+        return True
+    if 'A' in image.getbands():
+        return image.getchannel('A').getextrema()[0] == 255
+    return False
+
+
+def process_image(data, mime_type, max_size=0, png='KEEP', jpeg_quality=0):
+    """
+    Downscale and re-encode image data, does not use bpy,
+    so it's safe to call from worker threads.
+    Returns (data, mime_type, seconds). The original data is returned
+    when processing doesn't make it smaller.
+    """
+    start = time.perf_counter()
+    image = Image.open(io.BytesIO(data))
+    resized = False
+    if max_size and max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        resized = True
+
+    output = io.BytesIO()
+    if jpeg_quality and is_opaque(image):
+        image.convert('RGB').save(output, 'JPEG', quality=jpeg_quality, optimize=True)
+        result = output.getvalue(), 'image/jpeg'
+    elif PNG_LEVELS[png] is not None or resized:
+        level = PNG_LEVELS[png]
+        image.save(
+            output, 'PNG',
+            compress_level=6 if level is None else level,
+            optimize=png == 'BEST')
+        result = output.getvalue(), 'image/png'
+    else:
+        result = data, mime_type
+
+    if len(result[0]) >= len(data) and not resized:
+        result = data, mime_type
+
+    return result + (time.perf_counter() - start,)
@@ -17,22 +17,67 @@
 
 import bpy
 import bmesh
+import hashlib
+import numpy as np
+
+from .arrays import foreach_get
+
+
+def has_ngons(mesh):
+    return bool(np.any(foreach_get(mesh.polygons, 'loop_total', np.int32) > 4))
+
+
+def hash_mesh(mesh):
+    """
+    Hash of the exported mesh data: geometry, normals, uv layers,
+    materials and shape keys. Vertex weights are left out, they
+    come from the mesh data block, which is compared anyway.
+    """
+    digest = hashlib.sha1()
+    for items, attr, dtype, size in (
+            (mesh.vertices, 'co', np.float32, 3),
+            (mesh.loops, 'vertex_index', np.int32, 1),
+            (mesh.loops, 'normal', np.float32, 3),
+            (mesh.polygons, 'loop_total', np.int32, 1),
+            (mesh.polygons, 'use_smooth', bool, 1),
+            (mesh.polygons, 'material_index', np.int32, 1)):
+        digest.update(foreach_get(items, attr, dtype, size).tobytes())
+
+    for uv_name, uv_layer in mesh.uv_layers.items():
+        digest.update('{}:{}'.format(uv_name, uv_layer.active).encode())
+        digest.update(foreach_get(uv_layer.data, 'uv', np.float32, 2).tobytes())
+
+    digest.update(repr([
+        material.name if material else None
+        for material in mesh.materials]).encode())
+
+    if mesh.shape_keys:
+        for sk_name, key_block in mesh.shape_keys.key_blocks.items():
+            digest.update(sk_name.encode())
+            digest.update(foreach_get(key_block.data, 'co', np.float32, 3).tobytes())
+    return digest.hexdigest()
 
 
 def obj2mesh(obj, triangulate=True):
-    # convert the object to a mesh, so we can read the polygons
-    # https://docs.blender.org/api/blender2.8/bpy.types.Object.html?highlight=to_mesh#bpy.types.Object.to_mesh
-    # mesh = obj.to_mesh(
-    #     bpy.context.depsgraph, apply_modifiers=True, calc_undeformed=True)
-    mesh = obj.to_mesh()
+    # read triangles of the object mesh from mesh.loop_triangles,
+    # the mesh data is used as is, without a copy.
+    # Tangents are calculated for tris and quads only,
+    # meshes with n-gons are copied and triangulated,
+    # the copy is freed by obj.to_mesh_clear
+    mesh = obj.data
+    if triangulate and has_ngons(mesh):
+        mesh = triangulate_mesh(obj.to_mesh())
+    mesh.calc_loop_triangles()
+    return mesh
+
 
+def triangulate_mesh(mesh):
     # get a BMesh representation
     b_mesh = bmesh.new()
     b_mesh.from_mesh(mesh)
 
     # triangulate the mesh
-    if triangulate:
-        bmesh.ops.triangulate(b_mesh, faces=b_mesh.faces)
+    bmesh.ops.triangulate(b_mesh, faces=b_mesh.faces)
 
     # copy the bmesh back to the original mesh
     b_mesh.to_mesh(mesh)
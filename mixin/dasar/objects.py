@@ -43,6 +43,15 @@ def is_object_visible(obj):
     return True
 
 
+def get_applied_modifiers(obj):
+    """
+    Modifiers which apply_modifiers applies to the mesh.
+    """
+    return [
+        mod for mod in obj.modifiers
+        if mod and mod.show_viewport and mod.type not in ('ARMATURE', 'COLLISION')]
+
+
 def set_active_object(obj):
     bpy.context.view_layer.objects.active = obj
 
@@ -0,0 +1,97 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+import bpy
+
+from .armature import get_armature
+from .objects import get_object_properties, is_collision, is_object_visible
+
+
+class SceneSnapshot(object):
+    """
+    Object data the exporter asks for many times, read in one pass over
+    bpy.data. Same results as the functions of objects, collections and
+    armature, which are still used for objects made after the snapshot.
+    Make a new snapshot when objects are added, joined or renamed.
+    Excluded objects are not visible.
+    """
+    def __init__(self, excluded=()):
+        self._collections = {}  # object name -> collections, without RigidBodyWorld
+        hidden = set()  # objects in hidden collections
+        for collection in bpy.data.collections:
+            for obj in collection.objects:
+                if collection.name != 'RigidBodyWorld':
+                    self._collections.setdefault(obj.name, []).append(collection)
+                if collection.hide_viewport:
+                    hidden.add(obj.name)
+
+        self._visible = {}
+        self._collision = {}
+        self._armatures = {}
+        self._children = {}
+        self._roots = []
+        for obj in bpy.data.objects:
+            self._visible[obj.name] = (
+                obj.name not in hidden and obj.name not in excluded and
+                not obj.hide_viewport)
+            self._collision[obj.name] = is_collision(obj)
+            self._armatures[obj.name] = get_armature(obj)
+            self._children.setdefault(obj.name, [])
+            if obj.parent:
+                self._children.setdefault(obj.parent.name, []).append(obj)
+            else:
+                self._roots.append(obj)
+
+        self._properties = {}  # parsed on first use
+
+    def get_collections(self, obj):
+        return self._collections.get(obj.name, [])
+
+    def get_collection(self, obj):
+        collections = self.get_collections(obj)
+        if collections:
+            return collections[0]
+
+    def is_visible(self, obj):
+        visible = self._visible.get(obj.name)
+        if visible is None:
+            return is_object_visible(obj)
+        return visible
+
+    def is_collision(self, obj):
+        collision = self._collision.get(obj.name)
+        if collision is None:
+            return is_collision(obj)
+        return collision
+
+    def get_armature(self, obj):
+        if obj.name not in self._armatures:
+            return get_armature(obj)
+        return self._armatures[obj.name]
+
+    def get_properties(self, obj):
+        if obj.name not in self._properties:
+            self._properties[obj.name] = get_object_properties(obj)
+        return self._properties[obj.name]
+
+    def get_children(self, obj=None):
+        """
+        Children of the object, objects without parent when obj is None.
+        """
+        if obj is None:
+            return self._roots
+        if obj.name not in self._children:
+            return list(obj.children)
+        return self._children[obj.name]
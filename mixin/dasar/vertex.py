@@ -43,3 +43,6 @@ def normal_equals(n1, n2):
         return False
 
     return True
+
+
+WELD_TOLERANCE = 0.001
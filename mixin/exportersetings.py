@@ -18,15 +18,16 @@
 
 import bpy
 import mathutils  
+import numpy as np
 
 import os
 
-from .dasar.collections import get_object_collection
+from .dasar.arrays import foreach_get
 from .dasar.material import get_root_node, get_from_node
-from .dasar.vertex import uv_equals, normal_equals
-from .dasar.objects import (
-    get_object_properties, is_collision, is_object_visible,
-    set_active_object)
+from .dasar.vertex import normal_equals, uv_equals
+from .dasar.objects import set_active_object
+from .dasar.snapshot import SceneSnapshot
+from ..impread.write.dasar.g2_debug import profiled
 
 #-----
 class GeomMixin(object):
@@ -240,35 +241,44 @@ class VertexMixin(object):
 
         return results
 
-    def get_tangent_bitangent(self, mesh):
+    @profiled('tangents')
+    def get_tangent_bitangent(self, mesh, uv_names):
+        """
+        Get loop tangents of the given UV layers, only those are calculated.
+        Returns {uv name: ((loops x 3) tangents, (loops) bitangent signs)}.
+        The bitangent is cross(normal, tangent) * sign.
+        """
         results = {}
 
-        for uv_name, uv_layer in mesh.uv_layers.items():
+        for uv_name in uv_names:
             mesh.calc_tangents(uvmap=uv_name)
-            results[uv_name] = []
-            for i, loop in mesh.loops.items():
-                results[uv_name].append((
-                    mathutils.Vector(loop.tangent),
-                    mathutils.Vector(loop.bitangent),
-                    loop.bitangent_sign,
-                ))
+            results[uv_name] = (
+                foreach_get(mesh.loops, 'tangent', np.float32, 3),
+                foreach_get(mesh.loops, 'bitangent_sign', np.float32),
+            )
             mesh.free_tangents()
 
         return results
 
-    def can_share_vertex(self, mesh, vertex, loop_id, uv, normal):
-        if not mesh.uv_layers:
-            return True
-
-        if not mesh.uv_layers.active:
-            return True
-
-        uv_loop = mesh.uv_layers.active.data[loop_id]
-        # if uv_equals(uv_loop.uv.to_2d(), uv) and normal_equals(vertex.normal, normal):
-        if uv_equals(uv_loop.uv.to_2d(), uv) and normal_equals(mesh.loops[loop_id].normal, normal):
-            return True
-
-        return False
+    def find_shared_vertex(self, mesh, candidates, loop_id):
+        """
+        Index of the first (index, uv, normal) candidate the loop can
+        share, UV and normal within the tolerance. None if there is none.
+        """
+        if not mesh.uv_layers or not mesh.uv_layers.active:
+            return candidates[0][0] if candidates else None
+
+        uv = mesh.uv_layers.active.data[loop_id].uv.to_2d()
+        normal = mesh.loops[loop_id].normal
+        for index, candidate_uv, candidate_normal in candidates:
+            if uv_equals(uv, candidate_uv) and normal_equals(normal, candidate_normal):
+                return index
+        return None
+
+    def report_welded(self, obj, welded, loops):
+        if loops:
+            print('{}: {} of {} loops welded to shared vertices'.format(
+                obj.name, welded, loops))
 
 #-----------------------------------------------------------------------
 NOT_MERGED_TYPES = (
@@ -322,6 +332,10 @@ class Exporter(GeomMixin, MaterialMixin, TextureMixin, VertexMixin):
         self._empty_textures = args.empty_textures
         self._set_origin = args.set_origin is True
 
+        # objects, visibility, collections and properties, made by convert
+        self._scene = None
+        self._excluded = set(getattr(args, 'excluded', None) or ())
+
     def get_cwd(self):
         if self._inputs:
             return os.path.dirname(self._inputs[0])
@@ -341,17 +355,17 @@ class Exporter(GeomMixin, MaterialMixin, TextureMixin, VertexMixin):
         if not self._merge:
             return False
 
-        collection = get_object_collection(obj)
+        collection = self._scene.get_collection(obj)
         if not collection:
             return False
 
-        if is_collision(obj):
+        if self._scene.is_collision(obj):
             return False
 
-        if not is_object_visible(obj):
+        if not self._scene.is_visible(obj):
             return False
 
-        obj_props = get_object_properties(obj)
+        obj_props = self._scene.get_properties(obj)
         if obj_props.get('type') in NOT_MERGED_TYPES:
             return False
 
@@ -383,7 +397,7 @@ class Exporter(GeomMixin, MaterialMixin, TextureMixin, VertexMixin):
 
     def make_animation(self, parent_node, obj=None):
         for child in bpy.data.objects:
-            if not is_object_visible(child):
+            if not self._scene.is_visible(child):
                 continue
 
             if child.type == 'ARMATURE':
@@ -420,20 +434,18 @@ class Exporter(GeomMixin, MaterialMixin, TextureMixin, VertexMixin):
             return
 
         # make children of the current node
-        if obj is None:  # root objects
-            children = filter(lambda o: not o.parent, bpy.data.objects)
-        else:  # children on current object
-            children = obj.children
+        # root objects or children on current object
+        children = self._scene.get_children(obj)
 
         for child in children:
-            if not is_object_visible(child) and not is_collision(child):
+            if not self._scene.is_visible(child) and not self._scene.is_collision(child):
                 continue
 
             if self._export_type == 'collision':
                 if child.type in ('ARMATURE', 'LIGHT', 'LAMP'):
                     continue
 
-                if child.type == 'MESH' and not is_collision(child):
+                if child.type == 'MESH' and not self._scene.is_collision(child):
                     continue
 
             self.make_node(node, child)
@@ -444,6 +456,8 @@ class Exporter(GeomMixin, MaterialMixin, TextureMixin, VertexMixin):
                 if script_name:
                     self.execute_script(script_name)
 
+        self._scene = SceneSnapshot(self._excluded)
+
         if self._merge:
             for collection in bpy.data.collections:
                 if collection.name == 'RigidBodyWorld':
@@ -469,6 +483,9 @@ class Exporter(GeomMixin, MaterialMixin, TextureMixin, VertexMixin):
                 bpy.context.view_layer.objects.active.name = collection.name
                 set_active_object(None)
 
+            # objects were joined and renamed
+            self._scene = SceneSnapshot(self._excluded)
+
         self._root = self.make_root_node()
 
         if self._export_type == 'animation':
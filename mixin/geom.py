@@ -16,14 +16,22 @@
 # along with this program.  If not, see < https://www.gnu.org/licenses/ >.
 
 
-from .dasar.armature import get_armature
+import bpy
+import mathutils
+import numpy as np
+
+from .dasar.arrays import foreach_get, matrix_to_array, transform_points
 from .dasar.matrices import get_object_matrix
-from .dasar.mesh import obj2mesh
-from .dasar.objects import apply_modifiers, is_collision
+from .dasar.mesh import has_ngons, hash_mesh, obj2mesh, triangulate_mesh
+from .dasar.objects import apply_modifiers, get_applied_modifiers
+from ..impread.write.dasar.g2_debug import profiled
 
 #from . import spec
 from .dasar import spec
 
+# shape keys which move no vertex further than this are not exported
+TARGET_EPSILON = 1e-6
+
 class GeomMixin(object):
     def _get_joints(self, gltf_node):
         results = {}
@@ -99,13 +107,26 @@ class GeomMixin(object):
                     },
                 })
                 gltf_target['POSITION'] = channel['bufferView']
+                if self._sparse_targets:
+                    self._buffer.set_sparse(channel['bufferView'], self._sparse_targets)
 
                 gltf_primitive['targets'].append(gltf_target)
 
         return gltf_primitive
 
-    def make_geom(self, gltf_node, gltf_mesh, obj, can_merge=False):
+    @profiled('modifiers')
+    def _make_geom_mesh(self, obj):
+        """
+        Apply modifiers and get a triangulated copy of the object mesh.
+        The copy is freed by free_geom_meshes.
+        """
+        if obj.name in self._keyed_meshes:  # made by get_instance_key
+            return self._keyed_meshes.pop(obj.name)
+
         triangulate = True
+        if self._evaluated:
+            return self._make_evaluated_mesh(obj, triangulate=triangulate)
+
         if self._geom_scale != 1:
             scale = obj.scale
             obj.scale.x, obj.scale.y, obj.scale.z = [self._geom_scale] * 3
@@ -113,53 +134,144 @@ class GeomMixin(object):
             obj.scale = scale
         else:
             apply_modifiers(obj, triangulate=triangulate)
-        mesh = obj2mesh(obj, triangulate=triangulate)
-
-        # setup shape key names for the primitives
+        self._geom_meshes.append(obj)
+        return obj2mesh(obj, triangulate=triangulate)
+
+    def _make_evaluated_mesh(self, obj, triangulate=True):
+        """
+        Get a triangulated copy of the evaluated object mesh, the scene
+        is not changed. The geom scale and the transform of skinned objects,
+        which the pre-export applies to the scene, are applied to the copy.
+        """
+        source = obj
+        if get_applied_modifiers(obj):
+            depsgraph = bpy.context.evaluated_depsgraph_get()
+            source = obj.evaluated_get(depsgraph)
+            mesh = source.to_mesh(preserve_all_data_layers=True, depsgraph=depsgraph)
+        else:  # original mesh with shape keys
+            mesh = obj.to_mesh()
+        self._geom_meshes.append(source)
+
+        matrix = mathutils.Matrix.Scale(self._geom_scale, 4)
+        armature = self._scene.get_armature(obj)
+        if armature and self._pose_freeze:  # make_geom keeps skinned vertices as they are
+            matrix = get_object_matrix(obj, armature=armature) @ matrix
+        mesh.transform(matrix, shape_keys=True)
+
+        # tangents are calculated for tris and quads only
+        if triangulate and has_ngons(mesh):
+            triangulate_mesh(mesh)
+        mesh.calc_loop_triangles()
+        return mesh
+
+    def get_instance_key(self, obj):
+        """
+        Objects with the same key make the same glTF mesh and can share it.
+        Only objects of a mesh data block with more users have a key,
+        None otherwise. With applied modifiers the mesh made by
+        _make_geom_mesh is hashed too, it is kept for make_geom.
+        Skinned vertices are in the armature space, so the object
+        transform is a part of the key.
+        """
+        if obj.data is None or obj.data.users < 2:
+            return None
+
+        data = (type(obj.data).__name__, obj.data.name_full, None)
+        if get_applied_modifiers(obj):
+            mesh = self._make_geom_mesh(obj)
+            self._keyed_meshes[obj.name] = mesh
+            data = data[:2] + (hash_mesh(mesh),)
+
+        armature = self._scene.get_armature(obj)
+        skin = None
+        if armature:
+            matrix = get_object_matrix(obj, armature=armature)
+            skin = (
+                armature.name,
+                tuple(round(value, 6) for row in matrix for value in row),
+                tuple(vertex_group.name for vertex_group in obj.vertex_groups),
+                obj.parent_bone if obj.parent_type == 'BONE' else None)
+
+        return data, self._scene.is_collision(obj), skin
+
+    def free_geom_meshes(self):
+        """
+        Free the mesh copies made by _make_geom_mesh.
+        """
+        for source in self._geom_meshes:
+            source.to_mesh_clear()
+        self._geom_meshes = []
+        self._keyed_meshes = {}
+
+    @profiled('shape keys')
+    def _make_target_names(self, gltf_mesh, mesh, obj):
+        """
+        Setup shape key names for the primitives.
+        Returns (keys x vertices x 3) coordinates of the exported shape keys.
+        """
+        sk_names = []
         if mesh.shape_keys:
-            for sk_name in sorted(mesh.shape_keys.key_blocks.keys()):
-                if sk_name.lower() == 'basis':
-                    continue
-
-                gltf_mesh['extras']['targetNames'].append(sk_name)
-
+            sk_names = [
+                sk_name for sk_name in sorted(mesh.shape_keys.key_blocks.keys())
+                if sk_name.lower() != 'basis']
+
+        co = foreach_get(mesh.vertices, 'co', np.float32, 3)
+        sk_co = np.empty((len(sk_names), len(co), 3), dtype=np.float32)
+        for i, sk_name in enumerate(sk_names):
+            mesh.shape_keys.key_blocks[sk_name].data.foreach_get('co', sk_co[i].reshape(-1))
+
+        # skip shape keys which don't move anything
+        moved = np.any(np.abs(sk_co - co) > TARGET_EPSILON, axis=(1, 2))
+        skipped = [sk_name for sk_name, m in zip(sk_names, moved) if not m]
+        if skipped:
+            print('{}: shape keys without effect are not exported: {}'.format(
+                obj.name, ', '.join(skipped)))
+            self._null_targets.update(skipped)
+
+        gltf_mesh['extras']['targetNames'].extend(
+            sk_name for sk_name, m in zip(sk_names, moved) if m)
+        return sk_co[moved]
+
+    @profiled('shape keys')
+    def _get_target_deltas(self, sk_co, co):
+        """
+        Returns (keys x vertices x 3) shape key offsets from the exported positions.
+        """
+        sk_co = sk_co.astype(np.float64)
+        if not self._z_up:
+            sk_co = sk_co @ matrix_to_array(self._matrix).T
+        return sk_co - co
+
+    def _make_geom_materials(self, obj, mesh):
         # get or create materials and textures
         gltf_materials = {}
-        if not self._no_materials and not is_collision(obj):
+        if not self._no_materials and not self._scene.is_collision(obj):
             for material in mesh.materials.values():
                 # empty material slot
                 if not material:
                     continue
 
                 # material
-                for i, child in enumerate(self._root['materials']):  # existing material
-                    if child['name'] == material.name:
-                        gltf_materials[material.name] = i
-                        break
-                else:  # new material
+                matid = self._root.find('materials', material.name)  # existing material
+                if matid is None:  # new material
                     gltf_material = self.make_material(material)
-                    self._root['materials'].append(gltf_material)
+                    matid = self._root.add('materials', gltf_material)
 
-                    gltf_materials[material.name] = len(self._root['materials']) - 1
+                gltf_materials[material.name] = matid
 
                 # textures
                 if not self._no_textures:
                     for type_, gltf_sampler, gltf_image in self.make_textures(material):
                         tname = gltf_image['name']
-                        for i, child in enumerate(self._root['images']):  # existing texture
-                            if child['name'] == tname:
-                                texid = i
-                                break
-                        else:  # new texture
+                        texid = self._root.find('images', tname)  # existing texture
+                        if texid is None:  # new texture
                             self._root['samplers'].append(gltf_sampler)
-                            self._root['images'].append(gltf_image)
 
                             gltf_texture = {
                                 'sampler': len(self._root['samplers']) - 1,
-                                'source': len(self._root['images']) - 1,
+                                'source': self._root.add('images', gltf_image),
                             }
-                            self._root['textures'].append(gltf_texture)
-                            texid = len(self._root['textures']) - 1
+                            texid = self._root.add('textures', gltf_texture)
 
                         matid = gltf_materials[material.name]
                         if type(type_) == tuple and len(type_) == 2:
@@ -174,24 +286,11 @@ class GeomMixin(object):
                                 'texCoord': 0,
                             }
 
-        # get primitives
-        gltf_primitives = {}
-        gltf_primitive_indices = {}  # splitted vertex buffers
-        gltf_mesh_vertices_index = -1  # reusable vertex buffer
-        if can_merge:
-            for i, gltf_primitive in enumerate(gltf_mesh['primitives']):
-                mname = None
-                if 'material' in gltf_primitive:
-                    matid = gltf_primitive['material']
-                    mname = self._root['materials'][matid]['name']
-                gltf_primitives[mname] = gltf_primitive
-                gltf_primitive_indices[mname] = gltf_primitive['extras']['highest_index']
-
-        gltf_vertices = {}
+        return gltf_materials
 
+    def _get_geom_joints(self, gltf_node, obj):
         # get armature and joints
-        armature = get_armature(obj)
-        max_joints = 0  # get max joints per vertex
+        armature = self._scene.get_armature(obj)
         gltf_joints = {}
         if armature:
             # max_joints = 1
@@ -214,17 +313,151 @@ class GeomMixin(object):
                 #         break
                 gltf_joints = self._get_joints(gltf_skin)
 
+        return armature, gltf_joints
+
+    @profiled('skinning')
+    def _make_weight_table(self, obj, mesh, gltf_joints, max_joint_layers):
+        """
+        Get joints and weights of every vertex, the strongest first,
+        padded with zeros and limited to max_joint_layers * 4.
+        Returns (vertices x layers x 4) joint ids and weights.
+        """
+        size = max_joint_layers * 4
+
+        # vertex group index -> joint id, -1 for groups without bone
+        group_joints = np.array([
+            gltf_joints.get(vertex_group.name, -1)
+            for vertex_group in obj.vertex_groups], dtype=np.int64)
+
+        # all vertex group assignments, in vertex order
+        vertex_ids = []
+        group_ids = []
+        weights = []
+        for vertex in mesh.vertices:
+            for vertex_group in vertex.groups:
+                vertex_ids.append(vertex.index)
+                group_ids.append(vertex_group.group)
+                weights.append(vertex_group.weight)
+
+        vertex_ids = np.array(vertex_ids, dtype=np.int64)
+        joints = group_joints[np.array(group_ids, dtype=np.int64)]
+        weights = np.array(weights, dtype=np.float64)
+
+        # no bones with vertex group's name or weight is zero
+        used = (joints >= 0) & (weights > 0)
+        vertex_ids, joints, weights = vertex_ids[used], joints[used], weights[used]
+        priorities = weights.copy()
+
+        # objects reparented to bone instead of entire armature,
+        # the bone goes after the vertex groups
+        if obj.parent_type == 'BONE' and obj.parent_bone in gltf_joints:
+            vertex_ids = np.concatenate((vertex_ids, np.arange(len(mesh.vertices))))
+            joints = np.concatenate((
+                joints, np.full(len(mesh.vertices), gltf_joints[obj.parent_bone])))
+            weights = np.concatenate((weights, np.ones(len(mesh.vertices))))
+            priorities = np.concatenate((priorities, np.full(len(mesh.vertices), -0.5)))
+            order = np.argsort(vertex_ids, kind='stable')
+            vertex_ids, joints, weights, priorities = (
+                vertex_ids[order], joints[order], weights[order], priorities[order])
+
+        # dense (vertices x groups) tables, padded with -1 priority
+        starts = np.searchsorted(vertex_ids, vertex_ids)
+        columns = np.arange(len(vertex_ids)) - starts
+        width = max(size, int(columns.max()) + 1 if len(columns) else 0)
+        dense_joints = np.zeros((len(mesh.vertices), width), dtype=np.uint32)
+        dense_weights = np.zeros((len(mesh.vertices), width), dtype=np.float64)
+        dense_priorities = np.full((len(mesh.vertices), width), -1.0)
+        dense_joints[vertex_ids, columns] = joints
+        dense_weights[vertex_ids, columns] = weights
+        dense_priorities[vertex_ids, columns] = priorities
+
+        # limit by max joints, strongest first,
+        # the later vertex group first for the same weight
+        columns = np.broadcast_to(np.arange(width), dense_priorities.shape)
+        top = np.lexsort((-columns, -dense_priorities), axis=1)[:, :size]
+        joints = np.take_along_axis(dense_joints, top, axis=1)
+        weights = np.take_along_axis(dense_weights, top, axis=1)
+
+        # vertices without weights follow the root bone, like the helper
+        # bone which the pre-export assigns to meshes without vertex groups
+        unweighted = np.flatnonzero(weights.max(axis=1) <= 0)
+        if len(unweighted):
+            armature = self._scene.get_armature(obj)
+            root_joints = [
+                gltf_joints[bone.name] for bone in armature.data.bones
+                if not bone.parent and bone.name in gltf_joints]
+            if root_joints:
+                joints[unweighted] = 0
+                weights[unweighted] = 0
+                joints[unweighted, 0] = root_joints[0]
+                weights[unweighted, 0] = 1
+
+        # the strongest joint takes the rest up to 1
+        if self._norm_weights:
+            rows = np.flatnonzero(weights.max(axis=1) > 0)
+            imax = np.argmax(weights[rows], axis=1)
+            weights[rows, imax] += 1 - weights[rows].sum(axis=1)
+
+        return (
+            joints.reshape(-1, max_joint_layers, 4),
+            weights.reshape(-1, max_joint_layers, 4))
+
+    @profiled('mesh extraction')
+    def make_geom(self, gltf_node, gltf_mesh, obj, can_merge=False):
+        mesh = self._make_geom_mesh(obj)
+        sk_co = self._make_target_names(gltf_mesh, mesh, obj)
+        gltf_materials = self._make_geom_materials(obj, mesh)
+
+        # get primitives
+        gltf_primitives = {}
+        gltf_primitive_indices = {}  # splitted vertex buffers
+        gltf_mesh_vertices_index = -1  # reusable vertex buffer
+        if can_merge:
+            for i, gltf_primitive in enumerate(gltf_mesh['primitives']):
+                mname = None
+                if 'material' in gltf_primitive:
+                    matid = gltf_primitive['material']
+                    mname = self._root['materials'][matid]['name']
+                gltf_primitives[mname] = gltf_primitive
+                gltf_primitive_indices[mname] = gltf_primitive['extras']['highest_index']
+
+        gltf_vertices = {}  # vertex key -> index
+        welded = 0
+
+        armature, gltf_joints = self._get_geom_joints(gltf_node, obj)
+
         # get max joint layers (4 bones per layer)
         # max_joint_layers = math.ceil(max_joints / 4)
 
         # panda3d-gltf is limited to 1 single layer only (up to 4 bones)
-        max_joint_layers = 1
+        max_joint_layers = self._joint_layers
+        if gltf_joints:
+            joints, weights = self._make_weight_table(
+                obj, mesh, gltf_joints, max_joint_layers)
 
+        collision = self._scene.is_collision(obj)
         sharp_vertices = self.get_sharp_vertices(mesh)
-        uv_tb = self.get_tangent_bitangent(mesh)
+        # only the active layer tangents are exported
+        uv_tb = {}
+        if mesh.uv_layers.active and not collision:
+            uv_tb = self.get_tangent_bitangent(mesh, [mesh.uv_layers.active.name])
         obj_matrix = self._transform(get_object_matrix(obj, armature=armature))
 
-        for polygon in mesh.polygons:
+        # shape key offsets from the exported positions, as make_vertex does
+        can_merge_vertices = can_merge
+        if armature:
+            can_merge_vertices = True
+        elif collision:
+            can_merge_vertices = False
+        co = foreach_get(mesh.vertices, 'co', np.float32, 3).astype(np.float64)
+        if not self._z_up:
+            co = co @ matrix_to_array(self._matrix).T
+        if can_merge_vertices and not self._pose_freeze:
+            co = transform_points(obj_matrix, co)
+        sk_deltas = self._get_target_deltas(sk_co, co)
+        new_vertices = {}  # vertex buffers id -> (primitive, vertex ids)
+
+        for polygon in mesh.loop_triangles:  # polygons of the triangulated mesh
             # <-- polygon
             material = None
             mname = None
@@ -246,7 +479,7 @@ class GeomMixin(object):
                 gltf_mesh['primitives'].append(gltf_primitive)
 
             # set material
-            if material and not self._no_materials and not is_collision(obj):
+            if material and not self._no_materials and not collision:
                 if material.name in gltf_materials:
                     gltf_primitive['material'] = gltf_materials[mname]
 
@@ -257,45 +490,38 @@ class GeomMixin(object):
                 # vertex_id is reusable id,
                 # because multiple polygons can share the same vertices
 
-                loop_id = polygon.loop_indices[i]
+                loop_id = polygon.loops[i]
 
                 # <-- vertex
                 vertex = mesh.vertices[vertex_id]
                 use_smooth = (
                     polygon.use_smooth and
                     # vertex_id not in sharp_vertices and
-                    not is_collision(obj))
+                    not collision)
 
                 # try to reuse shared vertices
                 if mname not in gltf_vertices:
                     gltf_vertices[mname] = {}
-                if (polygon.use_smooth and vertex_id in
-                        gltf_vertices[mname] and
-                        not is_collision(obj)):
-                    shared = False
-                    for gltf_vertex_index, gltf_vertex_uv, gltf_vertex_normal in gltf_vertices[mname][vertex_id]:
-                        if self.can_share_vertex(mesh, vertex, loop_id, gltf_vertex_uv, gltf_vertex_normal):
-                            self._buffer.write(
-                                gltf_primitive['indices'], gltf_vertex_index)
-                            shared = True
-                            break
-                    if shared:
+                if polygon.use_smooth and not collision:
+                    shared = self.find_shared_vertex(
+                        mesh, gltf_vertices[mname].get(vertex_id, ()), loop_id)
+                    if shared is not None:
+                        self._buffer.write(gltf_primitive['indices'], shared)
+                        welded += 1
                         continue
 
                 # make new vertex data
-                can_merge_vertices = can_merge
-                if armature:
-                    can_merge_vertices = True
-                elif is_collision(obj):
-                    can_merge_vertices = False
                 self.make_vertex(
                     obj_matrix, gltf_primitive,
                     mesh, polygon, vertex, vertex_id, loop_id,
                     use_smooth=use_smooth, can_merge=can_merge_vertices)
+                new_vertices.setdefault(
+                    id(gltf_primitive['attributes']),
+                    (gltf_primitive, []))[1].append(vertex_id)
 
                 # uv layers, active first
                 active_uv = 0, 0
-                if not is_collision(obj):
+                if not collision:
                     uv_layers = sorted(
                         mesh.uv_layers.items(), key=lambda x: not x[1].active)
                     for uv_id, (uv_name, uv_layer) in enumerate(uv_layers):
@@ -311,9 +537,11 @@ class GeomMixin(object):
                             active_uv = u, v
                         self._write_uv(gltf_primitive, uv_id, u, v)
                         if uv_name in uv_tb and uv_layer.active:
+                            tangents, signs = uv_tb[uv_name]
                             self._write_tbs(
                                 obj_matrix, gltf_primitive,
-                                *uv_tb[uv_name][loop_id], can_merge=can_merge_vertices)
+                                mathutils.Vector(tangents[loop_id]), float(signs[loop_id]),
+                                can_merge=can_merge_vertices)
                         # vertex uv -->
 
                 # generate new ID, add vertex and save last ID
@@ -328,64 +556,32 @@ class GeomMixin(object):
                 gltf_primitive['extras']['highest_index'] = gltf_primitive_indices[mname]
 
                 # save vertex data for sharing
-                if vertex_id not in gltf_vertices[mname]:
-                    gltf_vertices[mname][vertex_id] = []
-                gltf_vertices[mname][vertex_id].append((
+                gltf_vertices[mname].setdefault(vertex_id, []).append((
                     idx, active_uv,
-                    mesh.loops[loop_id].normal if use_smooth else polygon.normal,
-                ))
+                    tuple(mesh.loops[loop_id].normal if use_smooth else polygon.normal)))
 
-                # attach joints to vertex
+                # attach joints to vertex, written with shape keys
                 if gltf_joints:
-                    joints_weights = []
-                    vertex_groups = reversed(sorted(
-                        vertex.groups, key=lambda vg: vg.weight))
-                    for vertex_group in vertex_groups:
-                        obj_vertex_group = obj.vertex_groups[vertex_group.group]
-
-                        # no bones with vertex group's name
-                        if obj_vertex_group.name not in gltf_joints:
-                            continue
-
-                        # weight is zero
-                        if vertex_group.weight <= 0:
-                            continue
-
-                        joint_id = gltf_joints[obj_vertex_group.name]
-                        joints_weights.append([joint_id, vertex_group.weight])
-
-                    # objects reparented to bone instead of entire armature
-                    if obj.parent_type == 'BONE' and obj.parent_bone in gltf_joints:
-                        joint_id = gltf_joints[obj.parent_bone]
-                        joints_weights.append([joint_id, 1])
-
-                    # padding
-                    while ((len(joints_weights) % 4 != 0) or
-                            (len(joints_weights) < max_joint_layers * 4)):
-                        joints_weights.append((0, 0))
-
-                    # limit by max joints
-                    joints_weights = joints_weights[:max_joint_layers * 4]
-
-                    imax = -1
-                    wmax = 0
-                    for j, (joint, weight) in enumerate(joints_weights):
-                        if weight > wmax:
-                            imax = j
-                            wmax = weight
-                    if self._norm_weights and imax >= 0:
-                        joints_weights[imax][1] += 1 - sum(list(zip(*joints_weights))[1])
-
-                    # group by 4 joint-weight pairs
-                    joints_weights_groups = []
-                    for j in range(len(joints_weights) // 4):
-                        group = joints_weights[j * 4: j * 4 + 4]
-                        joints_weights_groups.append(group)
-
-                    self._write_joints_weights(
-                        gltf_primitive,
-                        len(tuple(gltf_joints.keys())),
-                        joints_weights_groups)
+                    for i in range(max_joint_layers):
+                        self._get_joints_channel(gltf_primitive, i, len(gltf_joints))
+                        self._get_weights_channel(gltf_primitive, i)
 
                 # vertex -->
-            # polygon -->
\ No newline at end of file
+            # polygon -->
+
+        for gltf_primitive, vertex_ids in new_vertices.values():
+            # shape keys
+            for gltf_target, deltas in zip(gltf_primitive['targets'], sk_deltas):
+                self._buffer.write_array(gltf_target['POSITION'], deltas[vertex_ids])
+
+            # joints and weights
+            if gltf_joints:
+                for i in range(max_joint_layers):
+                    self._buffer.write_array(
+                        self._get_joints_channel(gltf_primitive, i, len(gltf_joints)),
+                        joints[vertex_ids, i])
+                    self._buffer.write_array(
+                        self._get_weights_channel(gltf_primitive, i),
+                        weights[vertex_ids, i])
+
+        self.report_welded(obj, welded, len(mesh.loop_triangles) * 3)
@@ -0,0 +1,267 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+import numpy as np
+
+from .dasar.arrays import foreach_get, matrix_to_array, transform_points
+from .dasar.matrices import get_object_matrix
+from .dasar.vertex import WELD_TOLERANCE
+from ..impread.write.dasar.g2_debug import profiled
+
+
+class NumpyGeomMixin(object):
+    """
+    Geometry engine which reads the mesh in bulk with foreach_get
+    and writes whole accessors at once.
+    Makes the same primitives and accessors as GeomMixin.make_geom.
+    """
+    def _weld_corners(self, corner_prims, corner_vertices, corner_smooth,
+                      corner_uvs, stored_normals, check_uv, prim_count):
+        """
+        Find reusable vertices, same rules as GeomMixin.find_shared_vertex:
+        a smooth corner takes the first earlier new vertex of the same
+        Blender vertex, with UV and normal within the tolerance.
+        Returns vertex index of every corner and mask of corners
+        which make a new vertex.
+        """
+        corners = np.arange(len(corner_vertices))
+        values = np.column_stack((
+            corner_uvs.astype(np.float64), stored_normals.astype(np.float64)))
+
+        # corners of the same primitive and vertex next to each other,
+        # rank is the position of the corner in its group
+        order = np.lexsort((corners, corner_vertices, corner_prims))
+        keys = np.column_stack((corner_prims[order], corner_vertices[order]))
+        starts = np.flatnonzero(np.concatenate(([True], np.any(keys[1:] != keys[:-1], axis=1))))
+        sizes = np.diff(np.concatenate((starts, [len(order)])))
+        ranks = np.arange(len(order)) - np.repeat(starts, sizes)
+
+        # decide rank by rank, candidates are all corners of lower ranks
+        is_new = np.ones(len(order), dtype=bool)  # in sorted order
+        first = np.arange(len(order))
+        smooth = corner_smooth[order]
+        for rank in range(1, int(sizes.max()) if len(sizes) else 0):
+            positions = np.flatnonzero((ranks == rank) & smooth)
+            if not len(positions):
+                continue
+            candidates = positions[:, None] - np.arange(rank, 0, -1)  # earlier first
+            matches = is_new[candidates]
+            if check_uv:
+                differences = np.abs(
+                    values[order[candidates]] - values[order[positions]][:, None])
+                matches &= np.all(differences <= WELD_TOLERANCE, axis=2)
+            found = np.any(matches, axis=1)
+            is_new[positions[found]] = False
+            first[positions[found]] = candidates[found, np.argmax(matches[found], axis=1)]
+
+        unsorted = np.argsort(order)
+        first = order[first][unsorted]
+        is_new = is_new[unsorted]
+
+        # generate new IDs
+        if self._split_primitives:
+            ids = np.zeros(len(corner_vertices), dtype=np.uint32)
+            for prim_id in range(prim_count):
+                prim_new = is_new & (corner_prims == prim_id)
+                ids[prim_new] = np.arange(np.count_nonzero(prim_new))
+        else:
+            ids = (np.cumsum(is_new) - 1).astype(np.uint32)
+
+        indices = ids[np.where(is_new, corners, first)]
+        return indices, is_new
+
+    @profiled('mesh extraction')
+    def make_geom(self, gltf_node, gltf_mesh, obj, can_merge=False):
+        if self._geom_engine != 'numpy' or can_merge:
+            return super().make_geom(gltf_node, gltf_mesh, obj, can_merge=can_merge)
+
+        mesh = self._make_geom_mesh(obj)
+        sk_co = self._make_target_names(gltf_mesh, mesh, obj)
+        gltf_materials = self._make_geom_materials(obj, mesh)
+        armature, gltf_joints = self._get_geom_joints(gltf_node, obj)
+
+        # panda3d-gltf is limited to 1 single layer only (up to 4 bones)
+        max_joint_layers = self._joint_layers
+        if gltf_joints:
+            joints, weights = self._make_weight_table(
+                obj, mesh, gltf_joints, max_joint_layers)
+
+        collision = self._scene.is_collision(obj)
+        can_merge_vertices = bool(armature)
+        obj_matrix = self._transform(get_object_matrix(obj, armature=armature))
+
+        # <-- bulk read
+        co = foreach_get(mesh.vertices, 'co', np.float32, 3)
+        loop_vertices = foreach_get(mesh.loops, 'vertex_index', np.int32)
+        loop_normals = foreach_get(mesh.loops, 'normal', np.float32, 3)
+        tri_loops = foreach_get(mesh.loop_triangles, 'loops', np.int32, 3)
+        tri_normals = foreach_get(mesh.loop_triangles, 'normal', np.float32, 3)
+        tri_smooth = foreach_get(mesh.loop_triangles, 'use_smooth', bool)
+        tri_materials = foreach_get(mesh.loop_triangles, 'material_index', np.int32)
+        if not len(tri_loops):
+            return
+
+        # triangle corners in the same order as triangle.loops
+        corner_tris = np.repeat(np.arange(len(tri_loops)), 3)
+        corner_loops = tri_loops.reshape(-1)
+        corner_vertices = loop_vertices[corner_loops]
+        corner_smooth = tri_smooth[corner_tris] & (not collision)
+
+        # primitives in order of the first triangle with the material
+        slot_names = []
+        if not self._no_materials:
+            slot_names = [
+                material.name if material else None
+                for material in mesh.materials]
+        name_ids = {}
+        slot_keys = np.array([
+            name_ids.setdefault(name, len(name_ids))
+            for name in slot_names + [None]])
+        tri_keys = slot_keys[np.minimum(tri_materials, len(slot_names))]
+        keys, first = np.unique(tri_keys, return_index=True)
+        keys = keys[np.argsort(first)]
+        prim_of_key = np.zeros(len(name_ids), dtype=np.int64)
+        prim_of_key[keys] = np.arange(len(keys))
+        corner_prims = prim_of_key[tri_keys][corner_tris]
+        mnames = list(name_ids.keys())
+
+        # uv layers, active first
+        uv_layers = []
+        if not collision:
+            uv_layers = sorted(
+                mesh.uv_layers.items(), key=lambda x: not x[1].active)
+
+        layer_uvs = {}
+        corner_uvs = np.zeros((len(corner_loops), 2), dtype=np.float32)
+        tangents = None
+        for uv_name, uv_layer in uv_layers:
+            if uv_layer.active or not self._no_extra_uv:
+                layer_uvs[uv_name] = foreach_get(uv_layer.data, 'uv', np.float32, 2)
+            if uv_layer.active:
+                corner_uvs = layer_uvs[uv_name][corner_loops]
+                tangents, signs = self.get_tangent_bitangent(mesh, [uv_name])[uv_name]
+
+        stored_normals = np.where(
+            corner_smooth[:, None],
+            loop_normals[corner_loops], tri_normals[corner_tris])
+        indices, is_new = self._weld_corners(
+            corner_prims, corner_vertices, corner_smooth, corner_uvs,
+            stored_normals, bool(mesh.uv_layers and mesh.uv_layers.active),
+            len(keys))
+        self.report_welded(obj, int(np.count_nonzero(~is_new)), len(is_new))
+        # bulk read -->
+
+        # <-- primitives
+        gltf_primitives = []
+        for prim_id, key in enumerate(keys):
+            mname = mnames[key]
+            gltf_primitive = self._make_primitive(gltf_mesh, mesh)
+            gltf_mesh['primitives'].append(gltf_primitive)
+            gltf_primitives.append(gltf_primitive)
+
+            # set material
+            if mname is not None and not collision and mname in gltf_materials:
+                gltf_primitive['material'] = gltf_materials[mname]
+
+            # attribute channels are made at the first vertex
+            for uv_id, (uv_name, uv_layer) in enumerate(uv_layers):
+                if not uv_layer.active and self._no_extra_uv:
+                    continue
+                self._get_uv_channel(gltf_primitive, uv_id)
+                if uv_layer.active:
+                    self._get_tangent_channel(gltf_primitive)
+
+            if gltf_joints:
+                for i in range(max_joint_layers):
+                    self._get_joints_channel(gltf_primitive, i, len(gltf_joints))
+                    self._get_weights_channel(gltf_primitive, i)
+
+            prim_mask = corner_prims == prim_id
+            self._buffer.write_array(gltf_primitive['indices'], indices[prim_mask])
+            gltf_primitive['extras']['highest_index'] = int(
+                np.count_nonzero(is_new & prim_mask)) - 1
+        # primitives -->
+
+        # <-- vertices
+        matrix = matrix_to_array(self._matrix)
+        co_t = co.astype(np.float64)
+        if not self._z_up:
+            co_t = co_t @ matrix.T
+
+        rotation = None
+        if can_merge_vertices and not self._pose_freeze:
+            rotation = obj_matrix.to_euler().to_matrix()
+            co_t = transform_points(obj_matrix, co_t)
+        sk_deltas = self._get_target_deltas(sk_co, co_t)
+
+        if self._split_primitives:
+            vertex_sets = [
+                (gltf_primitive, is_new & (corner_prims == prim_id))
+                for prim_id, gltf_primitive in enumerate(gltf_primitives)]
+        else:  # all primitives share the same vertex buffers
+            vertex_sets = [(gltf_primitives[0], is_new)]
+
+        for gltf_primitive, mask in vertex_sets:
+            corners = np.flatnonzero(mask)
+            vertices = corner_vertices[corners]
+            loops = corner_loops[corners]
+
+            # CO
+            self._buffer.write_array(
+                gltf_primitive['attributes']['POSITION'], co_t[vertices])
+
+            # normals
+            normals = stored_normals[corners].astype(np.float64)
+            if not self._z_up:
+                normals = normals @ matrix.T
+            if rotation is not None:
+                normals = transform_points(rotation, normals)
+            self._buffer.write_array(
+                gltf_primitive['attributes']['NORMAL'], normals)
+
+            # shape keys
+            for gltf_target, deltas in zip(gltf_primitive['targets'], sk_deltas):
+                self._buffer.write_array(gltf_target['POSITION'], deltas[vertices])
+
+            # uv layers, active first
+            for uv_id, (uv_name, uv_layer) in enumerate(uv_layers):
+                if not uv_layer.active and self._no_extra_uv:
+                    continue
+
+                uvs = layer_uvs[uv_name][loops].astype(np.float64)
+                uvs[:, 1] = 1 - uvs[:, 1]
+                self._buffer.write_array(
+                    self._get_uv_channel(gltf_primitive, uv_id), uvs)
+
+                if uv_layer.active and tangents is not None:
+                    t = tangents[loops].astype(np.float64)
+                    if not self._z_up:
+                        t = t @ matrix.T
+                    if rotation is not None:
+                        t = transform_points(rotation, t)
+                    self._buffer.write_array(
+                        self._get_tangent_channel(gltf_primitive),
+                        np.column_stack((t, signs[loops])))
+
+            # attach joints to vertices
+            if gltf_joints:
+                for j in range(max_joint_layers):
+                    self._buffer.write_array(
+                        self._get_joints_channel(gltf_primitive, j, len(gltf_joints)),
+                        joints[vertices, j])
+                    self._buffer.write_array(
+                        self._get_weights_channel(gltf_primitive, j),
+                        weights[vertices, j])
+        # vertices -->
@@ -16,6 +16,7 @@
 # along with this program.  If not, see < https://www.gnu.org/licenses/ >.
 
 from .dasar.material import get_root_node, get_from_node
+from ..impread.write.dasar.g2_debug import profiled
 
 SHADING_MODEL_DEFAULT = 0
 SHADING_MODEL_EMISSIVE = 1
@@ -27,6 +28,7 @@ SHADING_MODEL_TRANSPARENT_EMISSIVE = 6
 
 
 class MaterialMixin(object):
+    @profiled('materials')
     def make_material(self, material):
         gltf_material = {
             'name': material.name,
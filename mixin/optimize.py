@@ -0,0 +1,87 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+import numpy as np
+
+from .dasar import spec
+from .dasar.vertex_cache import VERTEX_CACHE_SIZE, count_cache_misses, fetch_order, tipsify
+from ..impread.write.dasar.g2_debug import profiled
+
+
+class OptimizeMixin(object):
+    """
+    Vertex cache optimization, triangles of the converted meshes are
+    reordered for the post-transform cache and vertices for fetching.
+    Vertex attributes can be interleaved into one buffer view.
+    """
+    @profiled('vertex cache')
+    def optimize_meshes(self, root):
+        for gltf_mesh in root['meshes']:
+            # primitives which share POSITION share all vertex buffers
+            vertex_sets = {}
+            for prim_id, gltf_primitive in enumerate(gltf_mesh['primitives']):
+                vertex_sets.setdefault(
+                    gltf_primitive['attributes']['POSITION'], []).append(
+                        ('{} #{}'.format(gltf_mesh['name'], prim_id), gltf_primitive))
+
+            for gltf_primitives in vertex_sets.values():
+                self._optimize_vertex_set(gltf_primitives)
+
+    def _optimize_vertex_set(self, gltf_primitives):
+        all_indices = []
+        for name, gltf_primitive in gltf_primitives:
+            indices = self._buffer.read_array(gltf_primitive['indices']).reshape(-1)
+            if not len(indices):
+                all_indices.append(indices)
+                continue
+
+            before = count_cache_misses(indices)
+            indices = indices.reshape(-1, 3)[tipsify(indices)].reshape(-1)
+            after = count_cache_misses(indices)
+            all_indices.append(indices)
+
+            # ACMR: vertices transformed per triangle, ATVR: per vertex
+            triangles = len(indices) // 3
+            vertices = len(np.unique(indices))
+            print('{}: ACMR {:.3f} -> {:.3f}, ATVR {:.3f} -> {:.3f} (cache {})'.format(
+                name, before / triangles, after / triangles,
+                before / vertices, after / vertices, VERTEX_CACHE_SIZE))
+
+        # vertices in the order of the first use, then all indices remapped
+        _, first_primitive = gltf_primitives[0]
+        attributes = first_primitive['attributes']
+        order, remap = fetch_order(
+            np.concatenate(all_indices), self._buffer.count(attributes['POSITION']))
+
+        for (_, gltf_primitive), indices in zip(gltf_primitives, all_indices):
+            self._buffer.rewrite(gltf_primitive['indices'], remap[indices])
+
+        channel_ids = list(attributes.values())
+        for gltf_target in first_primitive.get('targets', []):
+            channel_ids.extend(gltf_target.values())
+        for channel_id in set(channel_ids):
+            self._buffer.rewrite(channel_id, self._buffer.read_array(channel_id)[order])
+
+    def interleave_meshes(self, root):
+        """
+        Attributes of every vertex set go to a single strided buffer view,
+        morph targets stay in their own views (they may be sparse).
+        """
+        for gltf_mesh in root['meshes']:
+            for gltf_primitive in gltf_mesh['primitives']:
+                self._buffer.set_target(
+                    gltf_primitive['indices'], spec.ELEMENT_ARRAY_BUFFER)
+                # shared attributes are interleaved with the first primitive
+                self._buffer.interleave(list(gltf_primitive['attributes'].values()))
@@ -0,0 +1,200 @@
+# Copyright (c) 2024-2025 Roni Raihan
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see < https://www.gnu.org/licenses/ >.
+
+import collections
+import mathutils
+import numpy as np
+
+from .dasar import spec
+from ..impread.write.dasar.g2_debug import profiled
+
+# positions are rounded to -SHORT_MAX..SHORT_MAX steps around the center
+SHORT_MAX = 32767
+
+
+def quantize_unit(values, max_value):
+    """
+    Round -1..1 values to normalized integers of max_value steps.
+    """
+    return np.round(np.clip(values, -1, 1) * max_value)
+
+
+def quantize_weights(weights):
+    """
+    Round (vertices x joints) weights to normalized bytes. The sum of
+    every vertex is kept, the rounding error goes to its strongest joint.
+    """
+    quantized = np.round(np.clip(weights, 0, 1) * 255).astype(np.int64)
+    totals = np.minimum(np.round(weights.sum(axis=1) * 255), 255).astype(np.int64)
+    strongest = np.argmax(weights, axis=1)
+    rows = np.arange(len(weights))
+    quantized[rows, strongest] += totals - quantized.sum(axis=1)
+    return np.clip(quantized, 0, 255)
+
+
+class QuantizeMixin(object):
+    """
+    KHR_mesh_quantization, vertex attributes of the converted meshes
+    are rewritten with the smallest component types.
+    """
+    @profiled('quantization')
+    def quantize_meshes(self, root):
+        done = set()  # attributes shared by primitives are rewritten once
+        for gltf_mesh in root['meshes']:
+            for gltf_primitive in gltf_mesh['primitives']:
+                self._quantize_indices(gltf_primitive)
+                self._quantize_attributes(gltf_primitive, done)
+        self._quantize_positions(root)
+
+        root['extensionsUsed'].append('KHR_mesh_quantization')
+        root.setdefault('extensionsRequired', []).append('KHR_mesh_quantization')
+
+    def _quantize_indices(self, gltf_primitive):
+        channel_id = gltf_primitive['indices']
+        indices = self._buffer.read_array(channel_id)
+        highest = int(indices.max()) if len(indices) else 0
+
+        # the largest value of a type is reserved for primitive restart
+        if highest < 0xff:
+            ctype = spec.TYPE_UNSIGNED_BYTE
+        elif highest < 0xffff:
+            ctype = spec.TYPE_UNSIGNED_SHORT
+        else:
+            return
+
+        # Unity glTF importer (UniVRM/UniGLTF) compatibility
+        if self._output.endswith('.vrm'):
+            ctype = spec.TYPE_UNSIGNED_SHORT
+
+        self._buffer.rewrite(channel_id, indices, ctype)
+
+    def _quantize_attributes(self, gltf_primitive, done):
+        attributes = gltf_primitive['attributes']
+        for name, channel_id in attributes.items():
+            if channel_id in done:
+                continue
+
+            values = self._buffer.read_array(channel_id)
+            if name == 'NORMAL':  # VEC3 of bytes, padded to 4
+                self._buffer.rewrite(
+                    channel_id, quantize_unit(values, 127), spec.TYPE_BYTE,
+                    normalized=True, stride=4)
+            elif name == 'TANGENT':
+                self._buffer.rewrite(
+                    channel_id, quantize_unit(values, 127), spec.TYPE_BYTE,
+                    normalized=True)
+            elif name.startswith('TEXCOORD_'):
+                # tiled UVs would need KHR_texture_transform, kept as floats
+                if len(values) and (values.min() < 0 or values.max() > 1):
+                    continue
+                self._buffer.rewrite(
+                    channel_id, np.round(values * 0xffff), spec.TYPE_UNSIGNED_SHORT,
+                    normalized=True)
+            else:
+                continue
+            done.add(channel_id)
+
+        # weights of all layers are rounded together, to keep their sum
+        weights = sorted(name for name in attributes if name.startswith('WEIGHTS_'))
+        if weights and attributes[weights[0]] not in done:
+            quantized = quantize_weights(np.hstack([
+                self._buffer.read_array(attributes[name]) for name in weights]))
+            for i, name in enumerate(weights):
+                self._buffer.rewrite(
+                    attributes[name], quantized[:, i * 4:i * 4 + 4],
+                    spec.TYPE_UNSIGNED_BYTE, normalized=True)
+                done.add(attributes[name])
+
+    def _quantize_positions(self, root):
+        """
+        Positions to SHORT steps around the center of the meshes. Skinned
+        meshes ignore the node transform, they are dequantized by the
+        inverse bind matrices, so all meshes of a skin share the steps.
+        Other meshes are dequantized by their node transform, unless it
+        would move child nodes too.
+        """
+        users = collections.Counter(
+            node['mesh'] for node in root['nodes'] if 'mesh' in node)
+        groups = {}  # ('skin', skin id) or ('node', node id) -> mesh ids
+        for node_id, node in enumerate(root['nodes']):
+            if 'mesh' not in node:
+                continue
+            if 'skin' in node:
+                groups.setdefault(('skin', node['skin']), []).append(node['mesh'])
+            elif not node.get('children'):
+                groups.setdefault(('node', node_id), []).append(node['mesh'])
+
+        for (kind, item_id), mesh_ids in groups.items():
+            if any(users[mesh_id] > 1 for mesh_id in mesh_ids):
+                continue
+
+            positions = set()
+            targets = set()
+            for mesh_id in mesh_ids:
+                for gltf_primitive in root['meshes'][mesh_id]['primitives']:
+                    positions.add(gltf_primitive['attributes']['POSITION'])
+                    targets.update(
+                        gltf_target['POSITION'] for gltf_target in gltf_primitive['targets'])
+
+            arrays = {
+                channel_id: self._buffer.read_array(channel_id).astype(np.float64)
+                for channel_id in positions}
+            arrays = {
+                channel_id: array for channel_id, array in arrays.items() if len(array)}
+            if not arrays:
+                continue
+
+            low = np.min([array.min(axis=0) for array in arrays.values()], axis=0)
+            high = np.max([array.max(axis=0) for array in arrays.values()], axis=0)
+            center = (low + high) / 2
+            step = (high - low).max() / 2 / SHORT_MAX or 1  # uniform, keeps normals
+
+            for channel_id, array in arrays.items():  # VEC3 of shorts, padded to 4
+                self._buffer.rewrite(
+                    channel_id, np.round((array - center) / step), spec.TYPE_SHORT,
+                    stride=8, bounds=True)
+            for channel_id in targets:  # offsets stay floats, in steps
+                self._buffer.rewrite(
+                    channel_id, self._buffer.read_array(channel_id) / step)
+
+            if kind == 'skin':
+                self._dequantize_skin(root['skins'][item_id], center, step)
+            else:
+                self._dequantize_node(root['nodes'][item_id], center, step)
+
+    def _dequantize_skin(self, gltf_skin, center, step):
+        dequantize = np.diag([step, step, step, 1.0])
+        dequantize[:3, 3] = center
+
+        # column-major MAT4
+        channel_id = gltf_skin['inverseBindMatrices']
+        matrices = self._buffer.read_array(channel_id).astype(np.float64)
+        matrices = matrices.reshape(-1, 4, 4).transpose(0, 2, 1) @ dequantize
+        self._buffer.rewrite(channel_id, matrices.transpose(0, 2, 1).reshape(-1, 16))
+
+    def _dequantize_node(self, gltf_node, center, step):
+        if 'matrix' in gltf_node:
+            dequantize = np.diag([step, step, step, 1.0])
+            dequantize[:3, 3] = center
+            matrix = np.array(gltf_node['matrix'], dtype=np.float64).reshape(4, 4).T
+            gltf_node['matrix'] = (matrix @ dequantize).T.ravel().tolist()
+            return
+
+        x, y, z, w = gltf_node.get('rotation', [0, 0, 0, 1])
+        scale = np.array(gltf_node.get('scale', [1, 1, 1]), dtype=np.float64)
+        translation = np.array(gltf_node.get('translation', [0, 0, 0]), dtype=np.float64)
+        offset = mathutils.Quaternion((w, x, y, z)) @ mathutils.Vector(scale * center)
+        gltf_node['translation'] = (translation + np.array(offset)).tolist()
+        gltf_node['scale'] = (scale * step).tolist()
@@ -16,10 +16,33 @@
 # along with this program.  If not, see < https://www.gnu.org/licenses/ >.
 
 import bpy
+import concurrent.futures
 import os
 
 #from . import spec
 from .dasar import spec
+from .dasar import images
+from .dasar.cache import hash_data, make_key
+from ..impread.write.dasar.g2_debug import profiled
+
+# default size limit of the texture cache
+TEXTURE_CACHE_SIZE = 512 * 1024 * 1024
+
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+)
+
+
+def get_mime_type(data, default=None):
+    """
+    Detect image type by the file signature.
+    """
+    for signature, mime_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    return default
+
 
 class TextureMixin(object):
     def get_images(self, material, shader):
@@ -142,3 +165,127 @@ class TextureMixin(object):
             }
 
         return gltf_sampler, gltf_image
+
+    def get_image_params(self):
+        """
+        Processing parameters of embedded images, part of the cache key.
+        """
+        if not (self._texture_max_size or self._texture_png != 'KEEP' or
+                self._texture_jpeg_quality):
+            return {}
+
+        if not images.can_process_images():
+            print('Pillow is not installed, images are embedded without processing')
+            return {}
+
+        return {
+            'max_size': self._texture_max_size,
+            'png': self._texture_png,
+            'jpeg_quality': self._texture_jpeg_quality,
+        }
+
+    def get_base_color_images(self, root):
+        """
+        Returns ids of images used only as base color textures.
+        """
+        base_colors = set()
+        others = set()
+        for gltf_material in root.get('materials', []):
+            types = dict(gltf_material)
+            types.update(gltf_material.get('pbrMetallicRoughness') or {})
+            for type_, gltf_texinfo in types.items():
+                if not type_.endswith('Texture'):
+                    continue
+                image_id = root['textures'][gltf_texinfo['index']]['source']
+                if type_ == 'baseColorTexture':
+                    base_colors.add(image_id)
+                else:
+                    others.add(image_id)
+
+        return base_colors - others
+
+    def process_image(self, name, data, mime_type, params):
+        """
+        Returns final embedded image data and MIME type.
+        Images Pillow can't read (EXR, HDR, broken files) are embedded as is.
+        """
+        mime_type = get_mime_type(data, mime_type)
+        if not params:
+            return data, mime_type
+
+        try:
+            processed, processed_type, seconds = images.process_image(data, mime_type, **params)
+        except Exception as e:
+            print('WARNING: {}: image is embedded without processing, {}: {}'.format(
+                name, type(e).__name__, e))
+            return data, mime_type
+        print('{}: {} -> {} bytes ({:+.1%}) in {:.2f}s'.format(
+            name, len(data), len(processed),
+            len(processed) / len(data) - 1, seconds))
+        return processed, processed_type
+
+    @profiled('textures')
+    def embed_images(self, root):
+        """
+        Put embedded images through the texture cache and processing.
+        Images are cached by content hash and processing parameters,
+        unchanged images are copied from the cache into the buffer.
+        The other images are processed in parallel.
+        """
+        params = self.get_image_params()
+        if not (self._texture_cache or params):
+            return
+        base_colors = self.get_base_color_images(root)
+
+        pending = []
+        for image_id, gltf_image in enumerate(root.get('images', [])):
+            extras = gltf_image.get('extras') or {}
+
+            # JPEG has no alpha, only for base color with no transparency
+            image_params = params
+            if params and image_id not in base_colors:
+                image_params = dict(params, jpeg_quality=0)
+
+            if not (extras.get('data') or os.path.isfile(extras.get('uri', ''))):
+                continue
+
+            key = None
+            if self._texture_cache:
+                if extras.get('data'):
+                    hash_ = hash_data(extras['data'])
+                else:
+                    hash_ = self._texture_cache.get_hash(extras['uri'])
+
+                key = make_key(hash_, gltf_image['mimeType'], image_params)
+                cached = self._texture_cache.get(key)
+                if cached:
+                    extras.pop('data', None)
+                    extras['uri'], metadata = cached
+                    gltf_image['mimeType'] = metadata['mimeType']
+                    continue
+
+            pending.append((gltf_image, key, image_params))
+
+        def load(item):  # called from worker threads, no bpy here
+            gltf_image, key, params = item
+            data = gltf_image['extras'].get('data')
+            if not data:
+                with open(gltf_image['extras']['uri'], 'rb') as f:
+                    data = f.read()
+            return self.process_image(
+                gltf_image['name'], bytes(data), gltf_image['mimeType'], params)
+
+        # Pillow releases the GIL while decoding, resizing and encoding
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            results = list(pool.map(load, pending))
+
+        for (gltf_image, key, params), (data, mime_type) in zip(pending, results):
+            extras = gltf_image['extras']
+            if key:
+                extras.pop('data', None)
+                extras['uri'], metadata = self._texture_cache.put(
+                    key, data, {'mimeType': mime_type})
+            else:
+                extras.pop('uri', None)
+                extras['data'] = data
+            gltf_image['mimeType'] = mime_type
@@ -47,17 +47,9 @@ class VertexMixin(object):
         self._buffer.write(
             gltf_primitive['attributes']['NORMAL'], *tuple(normal))
 
-        # shape keys
-        for i, sk_name in enumerate(gltf_primitive['extras']['targetNames']):
-            sk_data = mesh.shape_keys.key_blocks[sk_name]
-            sk_co = sk_data.data[vertex_id].co
-            if not self._z_up:
-                sk_co = self._matrix @ sk_co
+        # shape keys are written for all vertices at once by make_geom
 
-            self._buffer.write(
-                gltf_primitive['targets'][i]['POSITION'], *tuple(sk_co - co))
-
-    def _write_uv(self, gltf_primitive, uv_id, u, v):
+    def _get_uv_channel(self, gltf_primitive, uv_id):
         texcoord = 'TEXCOORD_{}'.format(uv_id)
         if texcoord not in gltf_primitive['attributes']:
             channel = self._buffer.add_channel({
@@ -69,17 +61,9 @@ class VertexMixin(object):
             })
             gltf_primitive['attributes'][texcoord] = channel['bufferView']
 
-        self._buffer.write(
-            gltf_primitive['attributes'][texcoord], u, 1 - v)
-
-    def _write_tbs(self, obj_matrix, gltf_primitive, t, b, s, can_merge=False):
-        if not self._z_up:
-            t = self._matrix @ t
-        if can_merge and not self._pose_freeze:
-            # t = obj_matrix @ t
-            t = obj_matrix.to_euler().to_matrix() @ t
-        x, y, z = t
+        return gltf_primitive['attributes'][texcoord]
 
+    def _get_tangent_channel(self, gltf_primitive):
         if 'TANGENT' not in gltf_primitive['attributes']:
             channel = self._buffer.add_channel({
                 'componentType': spec.TYPE_FLOAT,
@@ -90,51 +74,58 @@ class VertexMixin(object):
             })
             gltf_primitive['attributes']['TANGENT'] = channel['bufferView']
 
+        return gltf_primitive['attributes']['TANGENT']
+
+    def _get_joints_channel(self, gltf_primitive, i, joints_num):
+        # prepare joints buffer channel
+        joints = 'JOINTS_{}'.format(i)
+        if joints not in gltf_primitive['attributes']:
+            if joints_num > 255:
+                ctype = spec.TYPE_UNSIGNED_SHORT
+            else:
+                ctype = spec.TYPE_UNSIGNED_BYTE
+
+            # Unity glTF importer (UniVRM/UniGLTF) compatibility
+            if self._output.endswith('.vrm'):
+                ctype = spec.TYPE_UNSIGNED_SHORT
+
+            channel = self._buffer.add_channel({
+                'componentType': ctype,
+                'type': 'VEC4',
+                'extras': {
+                    'reference': joints,
+                },
+            })
+            gltf_primitive['attributes'][joints] = channel['bufferView']
+
+        return gltf_primitive['attributes'][joints]
+
+    def _get_weights_channel(self, gltf_primitive, i):
+        # prepare weights buffer channel
+        weights = 'WEIGHTS_{}'.format(i)
+        if weights not in gltf_primitive['attributes']:
+            channel = self._buffer.add_channel({
+                'componentType': spec.TYPE_FLOAT,
+                'type': 'VEC4',
+                'extras': {
+                    'reference': weights,
+                },
+            })
+            gltf_primitive['attributes'][weights] = channel['bufferView']
+
+        return gltf_primitive['attributes'][weights]
+
+    def _write_uv(self, gltf_primitive, uv_id, u, v):
+        self._buffer.write(
+            self._get_uv_channel(gltf_primitive, uv_id), u, 1 - v)
+
+    def _write_tbs(self, obj_matrix, gltf_primitive, t, s, can_merge=False):
+        if not self._z_up:
+            t = self._matrix @ t
+        if can_merge and not self._pose_freeze:
+            # t = obj_matrix @ t
+            t = obj_matrix.to_euler().to_matrix() @ t
+        x, y, z = t
+
         self._buffer.write(
-            gltf_primitive['attributes']['TANGENT'], x, y, z, s)
-
-    def _write_joints_weights(
-            self, gltf_primitive, joints_num, joints_weights):
-        for i, joint_weight in enumerate(joints_weights):
-            # prepare joints buffer channel
-            joints = 'JOINTS_{}'.format(i)
-            if joints not in gltf_primitive['attributes']:
-                if joints_num > 255:
-                    ctype = spec.TYPE_UNSIGNED_SHORT
-                else:
-                    ctype = spec.TYPE_UNSIGNED_BYTE
-
-                # Unity glTF importer (UniVRM/UniGLTF) compatibility
-                if self._output.endswith('.vrm'):
-                    ctype = spec.TYPE_UNSIGNED_SHORT
-
-                channel = self._buffer.add_channel({
-                    'componentType': ctype,
-                    'type': 'VEC4',
-                    'extras': {
-                        'reference': joints,
-                    },
-                })
-                gltf_primitive['attributes'][joints] = channel['bufferView']
-
-            # write 4 joints
-            keys = tuple(zip(*joint_weight))[0]
-            assert len(keys) == 4
-            self._buffer.write(gltf_primitive['attributes'][joints], *keys)
-
-            # prepare weights buffer channel
-            weights = 'WEIGHTS_{}'.format(i)
-            if weights not in gltf_primitive['attributes']:
-                channel = self._buffer.add_channel({
-                    'componentType': spec.TYPE_FLOAT,
-                    'type': 'VEC4',
-                    'extras': {
-                        'reference': weights,
-                    },
-                })
-                gltf_primitive['attributes'][weights] = channel['bufferView']
-
-            # write 4 weights
-            values = tuple(zip(*joint_weight))[1]
-            assert len(values) == 4
-            self._buffer.write(gltf_primitive['attributes'][weights], *values)
+            self._get_tangent_channel(gltf_primitive), x, y, z, s)
@@ -33,6 +33,8 @@ from bpy_extras.io_utils import ExportHelper
 from typing import Set, cast
 
 from .gltfmodel import GLTFExporter
+from .generate import get_export_objects
+from .impread.write.dasar.g2_debug import profile_file, profile_stage
 
 #from . import spec
 from .mixin.dasar import spec
@@ -387,6 +389,7 @@ class VRMExporter(ArmatureMixin, GLTFExporter):
                 'materialValues': [],
             }
         }
+        vrm_bound = set()  # (blend shape name, mesh, shape key) of added binds
         for gltf_mesh_id, gltf_mesh in enumerate(root['meshes']):
             vrm_annotation = {
                 'firstPersonFlag': 'Auto',
@@ -402,10 +405,8 @@ class VRMExporter(ArmatureMixin, GLTFExporter):
                         vrm_blend_shape = self._make_vrm_blend_shape(sk_name)
                         vrm_blend_shapes[sk_name] = vrm_blend_shape
 
-                    for vrm_bind in vrm_blend_shape['binds']:
-                        if vrm_bind['mesh'] == gltf_mesh_id and vrm_bind['index'] == sk_id:
-                            break
-                    else:
+                    if (sk_name, gltf_mesh_id, sk_id) not in vrm_bound:
+                        vrm_bound.add((sk_name, gltf_mesh_id, sk_id))
                         vrm_bind = {
                             'mesh': gltf_mesh_id,
                             'index': sk_id,
@@ -413,6 +414,11 @@ class VRMExporter(ArmatureMixin, GLTFExporter):
                         }
                         vrm_blend_shape['binds'].append(vrm_bind)
 
+        # shape keys without effect have no targets, keep their groups without binds
+        for sk_name in sorted(self._null_targets):
+            if sk_name not in vrm_blend_shapes:
+                vrm_blend_shapes[sk_name] = self._make_vrm_blend_shape(sk_name)
+
         for vrm_blend_shape in vrm_blend_shapes.values():
             root['extensions']['VRM']['blendShapeMaster']['blendShapeGroups'].append(vrm_blend_shape)
 
@@ -427,14 +433,126 @@ class VRMExporterOperator(bpy.types.Operator, ExportHelper):
     filename_ext = '.vrm'
     filter_glob: bpy.props.StringProperty(default='*.vrm', options={'HIDDEN'})
 
+    geom_engine: EnumProperty(
+        name='Geometry Engine',
+        items=[
+            ('python', "Python", "Read the mesh vertex by vertex"),
+            ('numpy', "NumPy", "Read the mesh in bulk, faster on dense meshes"),
+        ],
+        default='python',
+    )
+    export_mode: EnumProperty(
+        name='Export Mode',
+        items=[
+            ('APPLY', "Apply", "Apply transforms and modifiers to the scene, undo them after the export"),
+            ('EVALUATED', "Evaluated", "Read evaluated meshes and apply transforms in the exporter, the scene is not changed"),
+        ],
+        default='APPLY',
+    )
+    bake_engine: EnumProperty(
+        name='Animation Bake',
+        items=[
+            ('fcurve', "F-Curves", "Evaluate action F-curves directly, bones with constraints or drivers use Scene"),
+            ('scene', "Scene", "Switch scene frames and read every bone"),
+        ],
+        default='scene',
+    )
+    bake_cache: BoolProperty(
+        name='Bake Cache',
+        description='Keep baked actions in a cache and reuse them while the F-curves, rest pose and settings are unchanged',
+        default=False,
+    )
+    key_tolerance: FloatProperty(
+        name='Keyframe Tolerance',
+        description='Remove animation keys which interpolation reproduces within this difference, 0 keeps every frame',
+        default=0, min=0, max=0.1, precision=5,
+    )
+    joint_layers: EnumProperty(
+        name='Bone Influences',
+        description='Max bones per vertex, 8 writes JOINTS_1 and WEIGHTS_1 too',
+        items=[
+            ('1', "4", "Up to 4 bones per vertex, supported everywhere"),
+            ('2', "8", "Up to 8 bones per vertex"),
+        ],
+        default='1',
+    )
+    sparse_targets: FloatProperty(
+        name='Sparse Morph Threshold',
+        description='Write shape keys which move less than this fraction of vertices as sparse accessors, 0 writes all shape keys dense',
+        default=0, min=0, max=1, subtype='FACTOR',
+    )
+    instance_meshes: BoolProperty(
+        name='Share Linked Meshes',
+        description='Objects with the same mesh, materials and skinning use one exported mesh',
+        default=False,
+    )
+    vertex_cache: BoolProperty(
+        name='Optimize Vertex Cache',
+        description='Reorder triangles and vertices of the meshes for faster rendering, the export takes longer',
+        default=False,
+    )
+    interleave: BoolProperty(
+        name='Interleave Vertices',
+        description='Store vertex attributes of a mesh together in one buffer view, fewer buffer views and faster loading on GPUs',
+        default=False,
+    )
+    quantize: BoolProperty(
+        name='Quantize Meshes',
+        description='Store vertex attributes as small integers (KHR_mesh_quantization), smaller files for viewers which support the extension',
+        default=False,
+    )
+    stream_memory: IntProperty(
+        name='Buffer Memory Limit',
+        description='Move exported buffers to a temporary file when they take more memory (MB), 0 moves them after every object',
+        default=512, min=0, max=65536,
+    )
+    texture_cache: BoolProperty(
+        name='Texture Cache',
+        description='Keep embedded images in a cache and reuse them while they are unchanged',
+        default=False,
+    )
+    texture_max_size: IntProperty(
+        name='Max Texture Size',
+        description='Downscale larger textures to this size, 0 keeps the original size (requires Pillow)',
+        default=0, min=0, max=16384,
+    )
+    texture_png: EnumProperty(
+        name='PNG Compression',
+        items=[
+            ('KEEP', "Keep", "Embed PNG textures as they are"),
+            ('FAST', "Fast", "Re-encode PNG textures with fast compression"),
+            ('DEFAULT', "Default", "Re-encode PNG textures with default compression"),
+            ('BEST', "Best", "Re-encode PNG textures with best compression, slow"),
+        ],
+        default='KEEP',
+    )
+    texture_jpeg_quality: IntProperty(
+        name='JPEG Quality',
+        description='Encode opaque base color textures as JPEG with this quality, 0 keeps them PNG (requires Pillow)',
+        default=0, min=0, max=100,
+    )
+    profile: BoolProperty(
+        name='Profile',
+        description='Write time and memory of every export stage to a .profile.json file next to the VRM',
+        default=False,
+    )
+
     def execute(self, context: bpy.types.Context):
         if not self.filepath:
             return {'CANCELLED'}
-        
+        if not self.profile:
+            return self.export_vrm(context)
+
+        with profile_file(os.path.splitext(self.filepath)[0] + '.profile.json'):
+            return self.export_vrm(context)
+
+    def export_vrm(self, context):
         dmta = bpy.context.scene.vrm_meta
         
-        bpy.ops.obj.generate_mhv()
-        bpy.ops.obj.cek_bsk()
+        evaluated = self.export_mode == 'EVALUATED'
+        with profile_stage('validation'):
+            bpy.ops.obj.generate_mhv(prepare=not evaluated)
+            bpy.ops.obj.cek_bsk()
         if dmta.amwsk_gagal == True:
             self.report({'ERROR'}, "Modifier cannot be applied to a mesh with shape keys, only 'armature' and 'collision' can")
             return {'CANCELLED'}
@@ -455,10 +573,15 @@ class VRMExporterOperator(bpy.types.Operator, ExportHelper):
             pesan_salahnya = ("Object '%s' has some Bone Parent Required is missing or incorrect!" % (dmta.rig.name))
             self.report({'ERROR'}, pesan_salahnya)
             return {'CANCELLED'}
-        else:
+        elif not evaluated:
             dmta.ingat_undo = True
             print ("jalan")
 
+        # objects which the pre-export would hide
+        excluded_names = []
+        if evaluated:
+            excluded_names = [obj.name for obj in get_export_objects(context, dmta)[1]]
+
         class Args(object):
             inputs = []
             output = self.filepath
@@ -476,6 +599,27 @@ class VRMExporterOperator(bpy.types.Operator, ExportHelper):
             empty_textures = None
             set_origin = None
             normalize_weights = None
+            geom_engine = self.geom_engine
+            bake_engine = self.bake_engine
+            bake_cache = (
+                bpy.utils.user_resource('DATAFILES', path='vrm_bake_cache', create=True)
+                if self.bake_cache else None)
+            key_tolerance = self.key_tolerance
+            sparse_targets = self.sparse_targets
+            joint_layers = int(self.joint_layers)
+            stream_memory = self.stream_memory
+            instance_meshes = self.instance_meshes
+            vertex_cache = self.vertex_cache
+            quantize = self.quantize
+            interleave = self.interleave
+            texture_cache = (
+                bpy.utils.user_resource('DATAFILES', path='vrm_texture_cache', create=True)
+                if self.texture_cache else None)
+            texture_max_size = self.texture_max_size
+            texture_png = self.texture_png
+            texture_jpeg_quality = self.texture_jpeg_quality
+            evaluated = self.export_mode == 'EVALUATED'
+            excluded = excluded_names
 
 
         bpy.context.window_manager.progress_begin(1, 100)
@@ -499,7 +643,8 @@ class VRMExporterOperator(bpy.types.Operator, ExportHelper):
         
         if bpy.app.timers.is_registered(kembalikan):
             bpy.app.timers.unregister(kembalikan)
-        bpy.app.timers.register(kembalikan, first_interval=0.2)
+        if not evaluated:  # nothing to undo
+            bpy.app.timers.register(kembalikan, first_interval=0.2)
 
         return {"FINISHED"}
 
@@ -507,7 +652,27 @@ class VRMExporterOperator(bpy.types.Operator, ExportHelper):
         return cast(Set[str], ExportHelper.invoke(self, context, event))
 
     def draw(self, context):
-        pass
+        layout = self.layout
+        layout.use_property_split = True
+        layout.use_property_decorate = False
+
+        layout.prop(self, "export_mode")
+        layout.prop(self, "geom_engine")
+        layout.prop(self, "bake_engine")
+        layout.prop(self, "bake_cache")
+        layout.prop(self, "key_tolerance")
+        layout.prop(self, "joint_layers")
+        layout.prop(self, "sparse_targets")
+        layout.prop(self, "instance_meshes")
+        layout.prop(self, "vertex_cache")
+        layout.prop(self, "quantize")
+        layout.prop(self, "interleave")
+        layout.prop(self, "stream_memory")
+        layout.prop(self, "texture_cache")
+        layout.prop(self, "texture_max_size")
+        layout.prop(self, "texture_png")
+        layout.prop(self, "texture_jpeg_quality")
+        layout.prop(self, "profile")
     
 #------------------------------------------------
 def kembalikan():